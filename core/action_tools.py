@@ -0,0 +1,107 @@
+import json
+import re
+
+# 以工具调用方式声明的操作，参数在执行前校验
+_INDEX = {"type": "integer", "minimum": 0, "description": "屏幕信息中的控件编号"}
+
+
+def _tool(name, description, properties):
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description,
+            "parameters": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+TOOLS = [
+    _tool("click", "单击控件", {"index": _INDEX}),
+    _tool("double", "双击控件", {"index": _INDEX}),
+    _tool("right", "右击控件", {"index": _INDEX}),
+    _tool("expand", "展开标注为已折叠的控件，下一步的屏幕信息将包含其子控件", {"index": _INDEX}),
+    _tool("input", "清空输入框后输入文本", {"index": _INDEX, "text": {"type": "string"}}),
+    _tool("press", "按键或组合键", {"keys": {"type": "string", "description": "标准键名，组合键用+连接，如ctrl+a、enter"}}),
+    _tool("sum", "用一句话总结本步操作", {"text": {"type": "string"}}),
+    _tool("done", "确认任务已经全部完成时调用，结束任务", {"text": {"type": "string", "description": "完成情况的总结"}}),
+]
+
+# 不需要AutoOperator执行的工具
+CONTROL_TOOLS = frozenset({"sum", "done"})
+
+DONE_PATTERN = re.compile(r"\s*done\((.*)\)\s*$")
+
+TOOL_NAMES = frozenset(tool["function"]["name"] for tool in TOOLS)
+
+
+class ToolAction:
+    """校验后的一次工具调用
+
+    match 与AutoOperator中正则匹配结果的格式相同，可直接交给_execute_single_action；
+    str() 为等价的文本操作，用于历史记录和界面显示。
+    """
+
+    __slots__ = ("name", "args")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    @property
+    def match(self):
+        if self.name == "input":
+            return str(self.args["index"]), self.args["text"]
+        if self.name == "press":
+            return self.args["keys"]
+        return str(self.args["index"])
+
+    def __str__(self):
+        if self.name == "input":
+            return f"input({self.args['index']}, {json.dumps(self.args['text'], ensure_ascii=False)})"
+        if self.name == "press":
+            return f"press({self.args['keys']})"
+        if self.name in CONTROL_TOOLS:
+            return f"{self.name}({self.args['text']})"
+        return f"{self.name}({self.args['index']})"
+
+
+def is_done(action_line):
+    """判断一行响应是否为表示任务完成的done()"""
+    if isinstance(action_line, ToolAction):
+        return action_line.name == "done"
+    return bool(action_line) and DONE_PATTERN.match(action_line) is not None
+
+
+def parse_tool_call(name, arguments):
+    """校验工具名和参数，返回ToolAction；无效时抛出ValueError，说明原因"""
+    if name not in TOOL_NAMES:
+        raise ValueError(f"未知的操作 {name}")
+    try:
+        args = json.loads(arguments or "{}")
+    except json.JSONDecodeError as e:
+        raise ValueError(f"{name} 的参数不是有效的JSON: {e}")
+    if not isinstance(args, dict):
+        raise ValueError(f"{name} 的参数应为对象")
+    schema = next(tool for tool in TOOLS if tool["function"]["name"] == name)["function"]["parameters"]
+    for key, spec in schema["properties"].items():
+        value = args.get(key)
+        if spec["type"] == "integer":
+            # 部分模型会把编号写成字符串
+            if isinstance(value, str) and value.strip().isdigit():
+                value = int(value)
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise ValueError(f"{name} 的参数 {key} 应为非负整数，实际为 {value!r}")
+        elif not isinstance(value, str):
+            raise ValueError(f"{name} 的参数 {key} 应为字符串，实际为 {value!r}")
+        elif key != "text" and not value.strip():
+            raise ValueError(f"{name} 的参数 {key} 不能为空")
+        args[key] = value
+    if name == "press":
+        args["keys"] = args["keys"].strip().strip('"').lower().replace(" ", "")
+    return ToolAction(name, {key: args[key] for key in schema["properties"]})
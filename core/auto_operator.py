@@ -6,6 +6,7 @@ import re
 import traceback
 from typing import Tuple, Optional, Union
 from core.debug import debug_print
+from core.action_tools import ToolAction, CONTROL_TOOLS
 
 import time
 import uiautomation as auto
@@ -13,6 +14,16 @@ from core.debug import debug_print
 
 class ElementHelper:
     """控件辅助类，用于处理窗口激活和元素滚动等操作"""
+
+    # 等待界面稳定的SettleWaiter，未设置时按上限固定等待
+    settle = None
+
+    @staticmethod
+    def wait_settled(timeout, window=None):
+        if ElementHelper.settle:
+            ElementHelper.settle.wait(timeout=timeout, quiet=min(ElementHelper.settle.quiet, timeout / 4), window=window)
+        else:
+            time.sleep(timeout)
     
     @staticmethod
     def is_element_in_window(element, window):
@@ -38,7 +49,7 @@ class ElementHelper:
         if not window: 
             return False
         window.SetFocus()
-        time.sleep(0.5)
+        ElementHelper.wait_settled(0.5, window)
         return window
     
     @staticmethod
@@ -54,7 +65,7 @@ class ElementHelper:
         except Exception as e:
             print(f"滚动1失败: {e}")
             pass 
-        time.sleep(0.5)
+        ElementHelper.wait_settled(0.5, window)
 
         # 滚动方式2：使用鼠标滚轮1
         
@@ -79,27 +90,37 @@ class ElementHelper:
 
 class AutoOperator:
     """自动化操作类，用于执行界面上的各种操作"""
+
+    PATTERNS = {
+        "input": r'input\((\d+),\s*"(.*?)"\)',
+        "press": r"press\((.*?)\)",
+        "click": r"click\((\d+)\)",
+        "double": r"double\((\d+)\)",
+        "right": r"right\((\d+)\)",
+        "move": r"move\((\d+)\)",
+        "drag": r"drag\((\d+)\)",
+        "expand": r"expand\((\d+)\)"
+    }
     
-    def __init__(self, screen_collector):
+    def __init__(self, screen_collector, settle=None):
         self.keyboard = Controller()
+        if settle:
+            ElementHelper.settle = settle
         self.last_error = None
         self.screen_collector = screen_collector
+        # 模型看到的屏幕信息对应的操作表；后台预取会替换采集器的optable，执行操作时以此为准
+        self.optable = None
         
-    def execute_action(self, action_line: str) -> bool:
+    def execute_action(self, action_line: Union[str, ToolAction]) -> bool:
         if not action_line: return False
-
-        patterns = {
-            "input": r'input\((\d+),\s*"(.*?)"\)',
-            "press": r"press\((.*?)\)",
-            "click": r"click\((\d+)\)",
-            "double": r"double\((\d+)\)",
-            "right": r"right\((\d+)\)",
-            "move": r"move\((\d+)\)",
-            "drag": r"drag\((\d+)\)"
-        }
+        self.last_error = None
+        if isinstance(action_line, ToolAction):
+            # 工具调用的参数已经校验过，不需要再用正则解析
+            if action_line.name in CONTROL_TOOLS: return True
+            return self._execute_single_action(action_line.name, action_line.match)
 
         try:
-            for action, pattern in patterns.items():
+            for action, pattern in self.PATTERNS.items():
                 matches = re.findall(pattern, action_line)
                 if not matches: continue
                     
@@ -111,6 +132,12 @@ class AutoOperator:
             self._set_error(f"执行操作时发生错误: {e}")
             return False
             
+    def is_action(self, action_line: Union[str, ToolAction]) -> bool:
+        """判断一行响应是否为需要执行的操作（sum等总结文字不是操作）"""
+        if isinstance(action_line, ToolAction):
+            return action_line.name not in CONTROL_TOOLS
+        return bool(action_line) and any(re.search(pattern, action_line) for pattern in self.PATTERNS.values())
+
     def _execute_single_action(self, action: str, match) -> bool:
         try:
             if action == "input":
@@ -120,6 +147,8 @@ class AutoOperator:
                 return self._handle_input(element, match[1])
             elif action == "press":
                 return self._handle_press(match)
+            elif action == "expand":
+                return self._handle_expand(int(match))
             else:
                 index = int(match)
                 element = self._find_element_by_index(index)
@@ -130,10 +159,12 @@ class AutoOperator:
             return False
 
     def _find_element_by_index(self, target_index: int):
-        for element_info in self.screen_collector.optable:
-            if element_info.index == target_index:
-                return element_info.item
-        return None
+        """按编号查找控件，编号在同一任务的各次快照中保持不变"""
+        optable = self.optable if self.optable is not None else self.screen_collector.optable
+        element = optable.item(target_index)
+        if element is None:
+            self._set_error(f"控件{target_index}不在当前屏幕信息中")
+        return element
         
     def _set_error(self, error_message: str):
         self.last_error = error_message
@@ -159,18 +190,26 @@ class AutoOperator:
     def _handle_press(self, key_combination):
         if isinstance(key_combination, tuple):
             key_combination = key_combination[0]
-                
-            if "+" in key_combination:
-                keys = key_combination.split('+')
-                for key in keys:
-                    pg.keyDown(key)
-                for key in reversed(keys):
-                    pg.keyUp(key)
-            else:
-                pg.press(key_combination)
+        if not isinstance(key_combination, str):
+            return False
+
+        keys = [key.strip().strip('"').lower() for key in key_combination.split('+')]
+        invalid = [key for key in keys if not pg.isValidKey(key)]
+        if invalid:
+            self._set_error(f"无效的键名: {', '.join(invalid)}")
+            return False
+        for key in keys:
+            pg.keyDown(key)
+        for key in reversed(keys):
+            pg.keyUp(key)
+        return True
+    
+    def _handle_expand(self, index: int) -> bool:
+        if self.screen_collector.expand_element(index, self.optable):
             return True
+        self._set_error(f"控件{index}不存在或没有已折叠的子控件")
         return False
-    
+
     def _handle_mouse_action(self, element, action: str) -> bool:
         # 预处理
         window = ElementHelper.activate_window(element)
@@ -0,0 +1,319 @@
+"""屏幕信息序列化的性能基准
+
+运行方式：py -m core.bench [节点数...]
+使用合成的元素树，不依赖实际的桌面窗口。
+
+比较屏幕信息格式的token数：py -m core.bench --corpus 目录
+目录中为设置ScreenInfo.record_dir后记录的快照（snapshot_*.json）。
+"""
+import dataclasses
+import gc
+import glob
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import deque
+from .screen_info import ElementInfo, ScreenInfoCollector
+from . import compact_format
+from .token_budget import estimate_tokens
+
+CONTROL_TYPES = [
+    ("ButtonControl", 30),
+    ("TextControl", 25),
+    ("GroupControl", 20),
+    ("ListItemControl", 10),
+    ("CheckBoxControl", 5),
+    ("RadioButtonControl", 5),
+    ("MenuItemControl", 5),
+]
+
+
+class FakeControl:
+    """模拟uiautomation控件对象的内存占用，实例属性与auto.Control相当"""
+    count = 0
+
+    def __init__(self):
+        FakeControl.count += 1
+        self._element = object()
+        self.searchFromControl = None
+        self.searchDepth = 0xFFFFFFFF
+        self.searchInterval = 0.5
+        self.foundIndex = 1
+        self.searchProperties = {}
+        self.regexName = None
+        self._id = FakeControl.count
+
+    def GetRuntimeId(self):
+        return [42, self._id]
+
+
+# 改写前的元素类型：不使用__slots__的普通数据类
+LegacyElementInfo = dataclasses.make_dataclass(
+    "LegacyElementInfo",
+    [(f.name, f.type, dataclasses.field(default=f.default, default_factory=f.default_factory))
+     for f in dataclasses.fields(ElementInfo)],
+    namespace={name: getattr(ElementInfo, name) for name in ("type", "is_enabled", "is_selected", "toggle_state")},
+)
+
+
+def make_element(rng, control_type=None, info_class=ElementInfo, with_items=False):
+    """创建一个合成元素，状态属性使用缓存字段，不访问控件对象"""
+    if control_type is None:
+        types, weights = zip(*CONTROL_TYPES)
+        control_type = rng.choices(types, weights)[0]
+    name = "" if rng.random() < 0.2 else f"{control_type[:-7]}{rng.randint(0, 99999)}"
+    return info_class(
+        item=FakeControl() if with_items else None,
+        name=name,
+        window_title="Bench",
+        cached_type=control_type,
+        cached_enabled=rng.random() < 0.9,
+        cached_selected=rng.random() < 0.5,
+        cached_toggle_state=rng.randint(0, 1),
+    )
+
+
+def build_tree(node_count, fanout=8, seed=0, **kwargs):
+    """按广度优先生成约node_count个节点的元素树，kwargs传给make_element"""
+    rng = random.Random(seed)
+    root = make_element(rng, "WindowControl", **kwargs)
+    queue = deque([root])
+    created = 1
+    while created < node_count:
+        parent = queue.popleft()
+        for _ in range(rng.randint(1, fanout * 2)):
+            if created >= node_count:
+                break
+            child = make_element(rng, **kwargs)
+            parent.children.append(child)
+            queue.append(child)
+            created += 1
+    return [root]
+
+
+def build_wide_tree(node_count, seed=0):
+    """生成一个包含大量同级元素的窗口，类似大型列表"""
+    rng = random.Random(seed)
+    root = make_element(rng, "WindowControl")
+    root.children = [make_element(rng) for _ in range(node_count - 1)]
+    return [root]
+
+
+def build_deep_tree(node_count, seed=0):
+    """生成一条很深的嵌套链，每层一个面板和一个按钮"""
+    rng = random.Random(seed)
+    root = make_element(rng, "WindowControl")
+    parent = root
+    for _ in range((node_count - 1) // 2):
+        pane = make_element(rng, "PaneControl")
+        parent.children = [make_element(rng, "ButtonControl"), pane]
+        parent = pane
+    return [root]
+
+
+def legacy_get_window_elements(collector, elements, info_class=ElementInfo):
+    """改写前的递归序列化实现，仅用于对比，会修改传入的元素树"""
+    collector.result = ""
+    collector.g_index = 0
+    collector.optable = []
+
+    def process_elements(elements_list, indent=0):
+        i = -1
+        while i < len(elements_list):
+            i += 1
+            if i >= len(elements_list):
+                break
+            if elements_list[i].type == "GroupControl" and len(elements_list[i].children) == 0:
+                elements_list.pop(i)
+                i -= 1
+                continue
+            if elements_list[i].type == "TextControl":
+                j = i + 1
+                while j < len(elements_list) and elements_list[j].type == "TextControl":
+                    elements_list[i].name += elements_list[j].name
+                    elements_list.pop(j)
+                if len(elements_list[i].name) > collector.max_text_length:
+                    elements_list[i].name = elements_list[i].name[:collector.max_text_length]
+            while (elements_list[i].type == "GroupControl" and
+                   len(elements_list[i].children) == 1 and
+                   elements_list[i].children[0].type != "GroupControl"):
+                elements_list[i] = elements_list[i].children[0]
+            typestr = elements_list[i].type.replace('Control', '')
+            elements_list[i].index = collector.g_index
+            status = collector.element_status(elements_list[i], typestr)
+            line = f"{collector.g_index} " + f"({typestr}) {elements_list[i].name}{status}\n"
+            element_info = info_class(
+                item=elements_list[i].item,
+                name=elements_list[i].name,
+                window_title=elements_list[i].window_title,
+                index=collector.g_index
+            )
+            if elements_list[i].name.strip():
+                collector.result += line
+                collector.optable.append(element_info)
+            collector.g_index += 1
+            if len(elements_list[i].children) > 0:
+                process_elements(elements_list[i].children, indent + 4)
+
+    process_elements(elements)
+    collector.result = collector.result.rstrip()
+    return collector.result
+
+
+def new_collector():
+    return ScreenInfoCollector()
+
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_serializer(sizes=(10_000, 100_000)):
+    """对比新旧序列化实现的耗时，并校验输出完全一致
+
+    合成的名称都很短，不会触发截断标记，因此两种实现的输出应当逐字节相同。
+    """
+    shapes = [("tree", build_tree), ("wide", build_wide_tree), ("deep", build_deep_tree)]
+    print(f"{'形状':<6}{'节点数':>10}{'旧实现(s)':>14}{'新实现(s)':>14}{'加速比':>10}")
+    for size in sizes:
+        for shape, builder in shapes:
+            elements = builder(size)
+            # 旧实现会修改元素树，使用相同种子重新生成一份
+            legacy_elements = builder(size)
+
+            new_result, new_time = time_call(new_collector().get_window_elements, None, None, elements)
+            try:
+                legacy_result, legacy_time = time_call(legacy_get_window_elements, new_collector(), legacy_elements)
+            except RecursionError:
+                print(f"{shape:<6}{size:>10}{'RecursionError':>14}{new_time:>14.4f}{'-':>10}")
+                continue
+
+            assert legacy_result == new_result, f"{shape}/{size} 输出不一致"
+            print(f"{shape:<6}{size:>10}{legacy_time:>14.4f}{new_time:>14.4f}{legacy_time / new_time:>9.1f}x")
+
+
+def measure_snapshot(build, serialize):
+    """返回 (快照结束后仍被引用的内存, 快照过程中的内存峰值)，单位为字节"""
+    gc.collect()
+    tracemalloc.start()
+    elements = build()
+    collector = serialize(elements)
+    del elements
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del collector
+    return retained, peak
+
+
+def bench_memory(sizes=(10_000, 100_000)):
+    """对比改写前后每次快照的内存占用
+
+    改写前：普通数据类元素树，每个节点都持有控件对象，optable为ElementInfo副本列表，
+    快照结束后仍保留最后一个窗口的元素树（collector.elements）；
+    改写后：__slots__元素树，不会输出的节点立即释放控件对象，按编号寻址的ElementTable，
+    没有树缓存时快照结束后不保留元素树。改写后的结果包含任务内的稳定编号表。
+    """
+    def legacy(elements):
+        collector = new_collector()
+        collector.elements = elements
+        legacy_get_window_elements(collector, elements, LegacyElementInfo)
+        return collector
+
+    def current(elements):
+        collector = new_collector()
+        collector.get_window_elements(None, None, elements)
+        # 与get_screen_info一致，快照结束后释放元素树
+        collector.elements = []
+        return collector
+
+    print(f"{'节点数':>10}{'旧保留(MB)':>14}{'新保留(MB)':>14}{'旧峰值(MB)':>14}{'新峰值(MB)':>14}")
+    for size in sizes:
+        legacy_retained, legacy_peak = measure_snapshot(
+            lambda: build_tree(size, info_class=LegacyElementInfo, with_items=True), legacy)
+        new_retained, new_peak = measure_snapshot(lambda: build_tree(size, with_items=True), current)
+        print(f"{size:>10}{legacy_retained / 2**20:>14.2f}{new_retained / 2**20:>14.2f}"
+              f"{legacy_peak / 2**20:>14.2f}{new_peak / 2**20:>14.2f}")
+
+
+def load_snapshot(path):
+    """读取record_snapshot记录的快照，返回 [(标题, 进程名, 元素列表)]"""
+    def element_from_record(record, window_title):
+        return ElementInfo(
+            item=None,
+            name=record["name"],
+            window_title=window_title,
+            cached_type=record["type"],
+            cached_enabled=record.get("enabled", True),
+            cached_selected=record.get("selected", False),
+            cached_toggle_state=record.get("toggle"),
+            collapsed_children=record.get("collapsed", 0),
+        )
+
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    windows = []
+    for window in data["windows"]:
+        roots = []
+        stack = [(record, roots) for record in reversed(window["elements"])]
+        while stack:
+            record, siblings = stack.pop()
+            element = element_from_record(record, window["title"])
+            siblings.append(element)
+            for child in reversed(record["children"]):
+                stack.append((child, element.children))
+        windows.append((window["title"], window["process"], roots))
+    return windows
+
+
+def render_snapshot(windows, output_format):
+    """按指定格式生成与get_screen_info相同结构的屏幕信息"""
+    collector = ScreenInfoCollector(config={"format": output_format})
+    result = ""
+    for window_title, process_name, elements in windows:
+        result += collector.window_header(window_title, process_name)
+        result += collector.get_window_elements(None, elements=elements) + "\n\n"
+    if output_format == "compact" and collector.used_types:
+        result = compact_format.legend(collector.used_types) + result
+    return result
+
+
+def bench_formats(corpus_dir=None):
+    """比较默认格式与紧凑格式的token数（使用token_budget中的近似估计）
+
+    没有指定快照目录时使用合成的元素树，合成名称几乎不重复，结果仅供参考。
+    """
+    if corpus_dir:
+        paths = sorted(glob.glob(os.path.join(corpus_dir, "snapshot_*.json")))
+        snapshots = [(os.path.basename(path), load_snapshot(path)) for path in paths]
+    else:
+        snapshots = [(f"synthetic_{size}", [("Bench", "bench.exe", build_tree(size, seed=size))])
+                     for size in (1_000, 10_000)]
+    if not snapshots:
+        print(f"{corpus_dir} 中没有快照")
+        return
+
+    print(f"{'快照':<40}{'默认格式':>12}{'紧凑格式':>12}{'节省':>8}")
+    total_default = total_compact = 0
+    for name, windows in snapshots:
+        default_tokens = estimate_tokens(render_snapshot(windows, "default"))
+        compact_tokens = estimate_tokens(render_snapshot(windows, "compact"))
+        total_default += default_tokens
+        total_compact += compact_tokens
+        print(f"{name:<40}{default_tokens:>12}{compact_tokens:>12}{1 - compact_tokens / default_tokens:>8.0%}")
+    print(f"{'合计':<40}{total_default:>12}{total_compact:>12}{1 - total_compact / total_default:>8.0%}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--corpus":
+        bench_formats(sys.argv[2])
+    else:
+        sizes = [int(arg) for arg in sys.argv[1:]] or (10_000, 100_000)
+        bench_serializer(sizes)
+        bench_memory(sizes)
+        bench_formats()
@@ -0,0 +1,83 @@
+import hashlib
+import time
+
+from .debug import debug_print
+
+
+def screen_digest(screen_info):
+    """屏幕信息的摘要，用于判断两次快照是否完全相同"""
+    return hashlib.sha1(screen_info.encode("utf-8")).digest()
+
+
+class ChangeGate:
+    """屏幕没有变化时避免重复采集和无效的模型调用
+
+    reuse：启用树缓存时，顶层窗口签名相同、已缓存的窗口中没有收到变化事件且缓存未过期，
+    即可直接使用最近一次快照，不必重新采集和序列化。
+    confirm：上一步操作成功但屏幕信息与上一步完全相同时，界面可能还没有更新完，
+    按recheck_waits依次多等待一段时间并重新确认；等到变化后再调用模型，省下一次基于旧屏幕的调用。
+    重新确认时先比较顶层窗口签名，签名不变时中间几次不重新采集，最后一次总是重新采集确认。
+    """
+
+    def __init__(self, collector, config=None):
+        config = config or {}
+        self.collector = collector
+        self.enabled = config.get("enabled", True)
+        self.recheck_waits = config.get("recheck_waits", [0.5, 1.0, 2.0])
+        self.last_screen = None     # 最近一步屏幕信息的摘要，TaskGuard直接使用
+        self.stats = {"reused": 0, "rechecks": 0, "saved_calls": 0, "confirmed_unchanged": 0}
+
+    def begin_task(self):
+        self.last_screen = None
+
+    def reuse(self):
+        """屏幕自最近一次快照以来没有变化时返回该快照的 (屏幕信息, 操作表)，否则返回None"""
+        if not self.enabled or not self.collector.snapshot_unchanged():
+            return None
+        self.stats["reused"] += 1
+        return self.collector.result, self.collector.optable
+
+    def changed_since_snapshot(self, final=False):
+        """重新确认屏幕是否变化，可能变化时重新采集并返回新的 (屏幕信息, 操作表)，否则返回None
+
+        中间几次先廉价地判断：有树缓存时签名相同、缓存的窗口中没有变化事件且未过期即视为没有变化；
+        没有树缓存时只看签名，签名不能反映窗口内容的变化（例如输入的文字）。
+        最后一次(final)总是重新采集，不发送事件的变化至迟在这时被发现，
+        换来的是屏幕确实没有变化时只完整采集一次。
+        """
+        collector = self.collector
+        if not final:
+            if collector.tree_cache is not None:
+                if collector.snapshot_unchanged():
+                    return None
+            elif not collector.signature_changed():
+                return None
+        screen_info = collector.get_screen_info()
+        return screen_info, collector.optable
+
+    def confirm(self, screen_info, optable, previous_acted):
+        """每一步采集屏幕信息后调用，返回实际用于本步的 (屏幕信息, 操作表)
+
+        screen_info 必须是采集器最近一次的快照。
+        """
+        digest = screen_digest(screen_info)
+        if self.enabled and previous_acted and digest == self.last_screen:
+            self.stats["rechecks"] += 1
+            for i, wait in enumerate(self.recheck_waits):
+                time.sleep(wait)
+                fresh = self.changed_since_snapshot(final=i == len(self.recheck_waits) - 1)
+                if fresh is None:
+                    continue
+                fresh_digest = screen_digest(fresh[0])
+                if fresh_digest != digest:
+                    self.stats["saved_calls"] += 1
+                    debug_print(f"屏幕在多等待{wait}秒后发生变化")
+                    screen_info, optable = fresh
+                    digest = fresh_digest
+                    break
+                # 重新采集后仍然相同，以新的快照为基准继续等待
+                screen_info, optable = fresh
+            else:
+                self.stats["confirmed_unchanged"] += 1
+        self.last_screen = digest
+        return screen_info, optable
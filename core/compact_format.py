@@ -0,0 +1,75 @@
+"""紧凑的屏幕信息编码
+
+每行为 "缩进 编号 类型代码 名称 状态"，缩进表示层级；窗口标题和进程名合并为一行；
+同一窗口中重复出现的较长名称用 $n 代替，并在窗口开头给出字典；
+装饰性控件和与父控件同名的非交互子控件不输出。
+"""
+
+TYPE_CODES = {
+    "WindowControl": "W", "PaneControl": "P", "ButtonControl": "B", "TextControl": "T",
+    "EditControl": "E", "GroupControl": "G", "ListControl": "L", "ListItemControl": "LI",
+    "CheckBoxControl": "CB", "RadioButtonControl": "RB", "MenuControl": "M", "MenuBarControl": "MB",
+    "MenuItemControl": "MI", "TabControl": "TB", "TabItemControl": "TI", "TreeControl": "TR",
+    "TreeItemControl": "TRI", "ComboBoxControl": "CO", "HyperlinkControl": "A", "DocumentControl": "D",
+    "ImageControl": "IM", "ToolBarControl": "TL", "StatusBarControl": "SB", "TitleBarControl": "TT",
+    "ScrollBarControl": "SC", "CustomControl": "C", "DataItemControl": "DI", "DataGridControl": "DG",
+    "TableControl": "TA", "HeaderControl": "H", "HeaderItemControl": "HI", "SplitButtonControl": "SP",
+    "SliderControl": "SL", "SpinnerControl": "SN", "ProgressBarControl": "PB", "CalendarControl": "CA",
+    "ToolTipControl": "TP", "SeparatorControl": "SE", "ThumbControl": "TH", "AppBarControl": "AB",
+    "SemanticZoomControl": "SZ",
+}
+
+# 不提供操作也不提供信息的控件，未折叠时不输出
+DECORATIVE_TYPES = frozenset({"ScrollBarControl", "ThumbControl", "SeparatorControl"})
+
+COMPACT_STATUS = {
+    " (已选中)": " [√]",
+    " (未选中)": " [ ]",
+    " (不可用)": " [禁用]",
+}
+
+# 字典编码的名称最短长度，以及引用一次的大致字符开销
+MIN_DICTIONARY_LENGTH = 6
+REFERENCE_COST = 3
+
+
+def type_code(control_type):
+    return TYPE_CODES.get(control_type, control_type.replace("Control", ""))
+
+
+def window_header(window_title, process_name):
+    return f"# {window_title} | {process_name}\n"
+
+
+def build_dictionary(names):
+    """选出值得用 $n 代替的重复名称，返回 {名称: 引用}，按首次出现的顺序编号"""
+    counts = {}
+    for name in names:
+        if len(name) >= MIN_DICTIONARY_LENGTH:
+            counts[name] = counts.get(name, 0) + 1
+    dictionary = {}
+    for name, count in counts.items():
+        # 字典中定义一次，每次引用节省 len(name) - REFERENCE_COST 个字符
+        if count > 1 and (count - 1) * len(name) > count * REFERENCE_COST + REFERENCE_COST * 2:
+            dictionary[name] = f"${len(dictionary) + 1}"
+    return dictionary
+
+
+def render(records):
+    """把 (层级, 编号, 控件类型, 名称, 状态, 折叠的子元素个数) 记录编码为文本"""
+    dictionary = build_dictionary(record[3] for record in records)
+    lines = [f"{reference}={name}\n" for name, reference in dictionary.items()]
+    for level, element_id, control_type, name, status, collapsed_children in records:
+        if collapsed_children:
+            status += f" [+{collapsed_children}]"
+        name = dictionary.get(name, name)
+        lines.append(f"{' ' * level}{element_id} {type_code(control_type)}{' ' + name if name else ''}{status}\n")
+    return "".join(lines)
+
+
+def legend(control_types):
+    """返回格式说明，只列出本次出现的类型代码"""
+    codes = ", ".join(f"{type_code(t)}={t.replace('Control', '')}" for t in sorted(control_types))
+    return ("格式: 每行为 编号 类型代码 名称，缩进表示层级；[√]/[ ] 为选中状态，[禁用] 为不可用，"
+            "[+N] 为已折叠N个子控件（可用expand展开）；$n 为窗口开头字典中的名称\n"
+            f"类型代码: {codes}\n\n")
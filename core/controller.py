@@ -3,17 +3,41 @@ from .llm_handler import LLMHandler
 from .auto_operator import AutoOperator
 from .utils import load_config
 from .ui_monitor import MonitorWindow
+from .snapshot_diff import SnapshotDiffer
+from .prefetch import SnapshotPrefetcher
+from .settle import SettleWaiter
+from .task_guard import TaskGuard
+from .change_gate import ChangeGate
+from .action_tools import is_done
 import time
 from core.debug import debug_print
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Controller:
     def __init__(self):
         self.config = load_config()
-        self.screen_collector = ScreenInfoCollector()
+        self.screen_collector = ScreenInfoCollector(config=self.config.get('ScreenInfo', {}))
         self.llm_handler = LLMHandler(self.config)
-        self.auto_operator = AutoOperator(self.screen_collector)
+        # 操作后等待界面稳定，而不是固定等待
+        self.settle = SettleWaiter(self.screen_collector, self.config.get('Settle', {}))
+        self.auto_operator = AutoOperator(self.screen_collector, settle=self.settle)
+        # 相邻两步之间只向模型发送屏幕信息的变化
+        self.screen_differ = SnapshotDiffer(self.config.get('ScreenDiff', {}))
+        # 操作完成后在后台预先采集下一步的屏幕信息
+        self.prefetcher = SnapshotPrefetcher(self.screen_collector, self.config.get('Pipeline', {}))
+        self.streaming = False
+        # 任务完成检测和无进展检测
+        self.task_guard = TaskGuard(self.config.get('TaskGuard', {}))
+        # 屏幕没有变化时复用上一次快照，操作后屏幕未更新时多等待再调用模型
+        self.change_gate = ChangeGate(self.screen_collector, self.config.get('ChangeGate', {}))
+        self.task_done = False
+        self.step_actions = []          # 本步执行的操作
+        self.step_failed = 0            # 本步失败的操作数
+        self.step_timings = {}
+        # 生成大纲与第一次采集屏幕信息同时进行
+        self.outline_executor = ThreadPoolExecutor(max_workers=1)
         
         # 创建监视器窗口
         self.ui = MonitorWindow()
@@ -39,68 +63,122 @@ class Controller:
         
     def run_task(self, task_str):
         """Main control loop that orchestrates the automation flow"""
+        self.screen_collector.begin_task()
+        self.screen_differ.reset()
+        self.task_guard.begin_task()
+        self.change_gate.begin_task()
+        self.task_done = False
+        stop_reason = None
+        
         # Generate initial task outline
-        outline = self.llm_handler.generate_outline(task_str)
+        # 大纲在后台生成（缓存命中时立即返回），同时采集第一次屏幕信息；
+        # 第一次采集时大纲尚不可用，相关性只按任务文本计算
+        outline_future = self.outline_executor.submit(self.llm_handler.generate_outline, task_str)
+        self.screen_collector.set_task_context(task_str)
+        try:
+            first_screen_info = self.screen_collector.get_screen_info()
+        except Exception as e:
+            print(f"采集屏幕信息时发生错误: {e}")
+            first_screen_info = None
+        outline = outline_future.result()
+        self.screen_collector.set_task_context(f"{task_str}\n{outline or ''}")
         
         # 显示任务信息到UI
         if self.ui:
             self.ui.add_llm_response(f"任务: {task_str}\n\n大纲:\n{outline}")
         
-        while self.running:
+        while self.running and not self.task_done:
             try:
                 # 检查是否暂停
                 if self.ui:
                     self.ui.wait_if_paused()
                 
                 # 1. Collect screen information
-                screen_info = self.screen_collector.get_screen_info()
-                screen_info += "上一步操作已被执行，继续下一步操作\n\n"
-                debug_print(f"屏幕信息: {screen_info}")
+                # 优先使用仍然有效的预取结果
+                self.step_timings = {"actions": 0.0, "settle": 0.0}
+                phase_start = time.perf_counter()
+                prefetched = self.prefetcher.take()
+                if first_screen_info is not None:
+                    screen_info, optable = first_screen_info, self.screen_collector.optable
+                    first_screen_info = None
+                elif prefetched is not None:
+                    screen_info, optable = prefetched
+                else:
+                    reused = self.change_gate.reuse()
+                    if reused is not None:
+                        screen_info, optable = reused
+                    else:
+                        screen_info = self.screen_collector.get_screen_info()
+                        optable = self.screen_collector.optable
+                # 上一步操作成功但屏幕没有变化时，多等待并重新确认后再调用模型
+                screen_info, optable = self.change_gate.confirm(screen_info, optable, self.task_guard.previous_acted)
+                self.auto_operator.optable = optable
+                self.step_timings["collect"] = time.perf_counter() - phase_start
+                self.step_timings["prefetched"] = prefetched is not None
                 
                 # 显示屏幕信息到UI
                 if self.ui:
                     self.ui.add_screen_info(screen_info)
                 
+                # 没有进展时先提示模型，仍无改善则停止任务
+                warning, stop_reason = self.task_guard.check_screen(self.change_gate.last_screen)
+                if stop_reason:
+                    break
+                if warning:
+                    last_error = self.llm_handler.last_error
+                    self.llm_handler.set_last_error(f"{last_error}\n{warning}" if last_error else warning)
+                
+                prompt_screen_info, full_screen = self.screen_differ.render(screen_info)
+                prompt_screen_info += "上一步操作已被执行，继续下一步操作\n\n"
+                debug_print(f"屏幕信息: {prompt_screen_info}")
+                
                 # 2. Send to LLM and get response
+                # 流式模式下每收到一行操作就立即执行，生成与执行重叠进行
+                streaming = self.streaming = self.llm_handler.stream
+                # 模型生成期间在后台刷新树缓存
+                self.prefetcher.refresh()
+                self.step_actions = []
+                self.step_failed = 0
+                phase_start = time.perf_counter()
                 llm_response = self.llm_handler.process_task(
                     task_str=task_str,
-                    screen_info=screen_info,
-                    outline=outline
+                    screen_info=prompt_screen_info,
+                    outline=outline,
+                    full_screen=full_screen,
+                    screen_change=self.screen_differ.change_ratio,
+                    on_line=self.execute_line if streaming else None
                 )
+                self.step_timings["llm"] = time.perf_counter() - phase_start
                 
                 if not llm_response:
                     print("未能获取有效的 LLM 响应。")
                     # 显示错误到UI
                     if self.ui:
                         self.ui.add_llm_response("未能获取有效的 LLM 响应")
+                    self.task_guard.record_step(False, self.step_actions, self.step_failed)
                     continue
+                self.screen_differ.commit()
+                debug_print(f"屏幕信息发送统计: {self.screen_differ.stats}")
                 
                 # 显示LLM响应到UI
                 if self.ui:
                     self.ui.add_llm_response(llm_response)
                 
                 # 3. Execute the actions
-                for line in llm_response.split("\n"):
-                    if not self.running:
-                        break
-                    
-                    # 执行每个动作前检查是否暂停
-                    if self.ui:
-                        self.ui.wait_if_paused()
-                        
-                    if self.auto_operator.execute_action(line):
-                        # 显示执行的操作到UI
-                        if self.ui:
-                            self.ui.add_action(f"执行成功: {line}")
-                        time.sleep(2)  # Wait between actions
-                    else:
-                        # If action failed, send error to LLM
-                        error = self.auto_operator.get_last_error()
-                        if error:
-                            self.llm_handler.set_last_error(error)
-                            # 显示错误到UI
-                            if self.ui:
-                                self.ui.add_action(f"执行失败: {line}\n错误: {error}")
+                if not streaming:
+                    # 工具调用模式下直接执行校验过的操作
+                    actions = self.llm_handler.actions
+                    for line in actions if actions is not None else llm_response.split("\n"):
+                        if not self.execute_line(line):
+                            break
+                
+                self.task_guard.record_step(True, self.step_actions, self.step_failed, self.task_done)
+                
+                # 流式模式下操作与模型生成重叠的时间
+                self.step_timings["overlap"] = self.step_timings["actions"] if streaming else 0.0
+                debug_print(f"步骤耗时: { {k: round(v, 3) if isinstance(v, float) else v for k, v in self.step_timings.items()} }，"
+                            f"预取统计: {self.prefetcher.stats}，稳定等待统计: {self.settle.stats}，"
+                            f"屏幕变化检查统计: {self.change_gate.stats}")
                         
             except Exception as e:
                 print(f"执行任务时发生错误: {e}")
@@ -110,10 +188,75 @@ class Controller:
                 time.sleep(1)  # Brief pause before retrying
             finally:
                 self.ui.bring_to_front()
+        
+        self.report_task(stop_reason)
+    
+    def report_task(self, stop_reason=None):
+        """报告任务结束的原因和模型调用的浪费情况"""
+        if self.task_done:
+            reason = "模型确认任务已完成"
+        elif stop_reason:
+            reason = f"无进展，已停止：{stop_reason}"
+        else:
+            reason = "任务被停止"
+        stats = self.task_guard.stats
+        message = (f"任务结束：{reason}\n共{self.task_guard.steps}步，模型调用{stats['llm_calls']}次，"
+                   f"其中无效调用{stats['wasted_calls']}次（无有效响应{stats['no_response']}次，没有给出操作{stats['no_action']}次，"
+                   f"操作全部失败{stats['failed_actions']}次，操作后屏幕无变化{stats['no_effect']}次），"
+                   f"等待屏幕更新后避免的调用{self.change_gate.stats['saved_calls']}次")
+        print(message)
+        if self.ui:
+            self.ui.add_llm_response(message)
+    
+    def execute_line(self, line):
+        """执行响应中的一行，返回是否继续执行后续的行"""
+        if not self.running:
+            return False
+        
+        # 模型确认任务完成，不再执行后续的行
+        if is_done(line):
+            self.task_done = True
+            if self.ui:
+                self.ui.add_action(f"任务完成: {line}")
+            return False
+        
+        # 总结等非操作的行不需要执行
+        if not self.auto_operator.is_action(line):
+            return True
+        
+        # 执行每个动作前检查是否暂停
+        if self.ui:
+            self.ui.wait_if_paused()
+        
+        # 操作开始前已开始的预取不再有效
+        self.prefetcher.action_executed()
+        phase_start = time.perf_counter()
+        self.step_actions.append(str(line).strip())
+        if self.auto_operator.execute_action(line):
+            # 显示执行的操作到UI
+            if self.ui:
+                self.ui.add_action(f"执行成功: {line}")
+            self.step_timings["settle"] = self.step_timings.get("settle", 0.0) + self.settle.wait()
+            # 流式模式下模型可能仍在生成，在后台开始采集下一步的屏幕信息
+            if self.streaming:
+                self.prefetcher.start()
+        else:
+            # If action failed, send error to LLM
+            self.step_failed += 1
+            error = self.auto_operator.get_last_error()
+            if error:
+                self.llm_handler.set_last_error(error)
+                # 显示错误到UI
+                if self.ui:
+                    self.ui.add_action(f"执行失败: {line}\n错误: {error}")
+        self.step_timings["actions"] = self.step_timings.get("actions", 0.0) + time.perf_counter() - phase_start
+        return self.running
     
     def stop_task(self):
         """停止当前任务"""
         self.running = False
+        # 立即取消正在等待的模型请求
+        self.llm_handler.transport.cancel_all()
         if self.task_thread and self.task_thread.is_alive():
             self.task_thread.join(timeout=2)
         self.running = True
@@ -123,6 +266,11 @@ class Controller:
         self.running = False
         if self.task_thread and self.task_thread.is_alive():
             self.task_thread.join(timeout=2)
+        self.llm_handler.transport.cancel_all()
+        self.screen_collector.close()
+        self.outline_executor.shutdown(wait=False)
+        self.prefetcher.close()
+        self.llm_handler.transport.close()
         if self.ui:
             self.ui.close()
 
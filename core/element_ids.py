@@ -0,0 +1,46 @@
+from array import array
+
+
+class StableIdRegistry:
+    """在同一任务内为界面元素分配稳定的编号
+
+    元素优先以UI自动化的RuntimeId识别；没有RuntimeId的元素以结构路径识别，
+    即 (父元素的编号, 控件类型, 在同类型兄弟元素中的序号)。
+    父元素以编号表示，因此路径键的长度与树的深度无关。
+    编号按首次出现的顺序从0开始分配，同一元素在后续快照中沿用原编号。
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """开始新任务，之前分配的编号全部作废"""
+        self.ids = {}               # RuntimeId元组或路径键 -> 编号
+        self.next_id = 0
+        self.snapshot = 1
+        self.last_used = array("l")  # 编号 -> 最近一次使用该编号的快照序号
+
+    def begin_snapshot(self):
+        self.snapshot += 1
+
+    def element_id(self, runtime_id, parent_id, control_type, ordinal):
+        """返回元素的编号，首次出现时分配新编号
+
+        parent_id 为父元素的编号，顶层元素传入窗口标识。
+        RuntimeId全部由整数组成，路径键中含有字符串，两种键不会冲突。
+        """
+        key = runtime_id or (parent_id, control_type, ordinal)
+        element_id = self.ids.get(key)
+        if element_id is None:
+            element_id = self.ids[key] = self._new_id()
+        elif self.last_used[element_id] == self.snapshot:
+            # 同一快照中重复出现的元素（RuntimeId被复用等情况）使用新编号，避免歧义
+            element_id = self._new_id()
+        self.last_used[element_id] = self.snapshot
+        return element_id
+
+    def _new_id(self):
+        element_id = self.next_id
+        self.next_id += 1
+        self.last_used.append(0)
+        return element_id
@@ -1,23 +1,114 @@
-from openai import OpenAI
 import traceback
 import re
+import time
+from .action_tools import TOOLS, parse_tool_call
+from .llm_transport import LLMTransport, RequestCancelled
+from .model_router import ModelRouter
+from .outline_cache import OutlineCache, prompt_version
+from .token_budget import estimate_tokens
+from .debug import debug_print
+
+# 压缩后的历史记录中代替屏幕信息的占位符
+SCREEN_PLACEHOLDER = "（该步骤的屏幕信息已省略）"
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+
+def _partial_tag(text, tag):
+    """返回text末尾可能是tag开头部分的字符数"""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+
+class ThinkFilter:
+    """流式地移除<think></think>标签内的内容，标签可能被拆分在多个分块中"""
+
+    def __init__(self):
+        self.inside = False
+        self.pending = ""
+
+    def feed(self, text):
+        """输入一个分块，返回可以确定不在<think>标签内的文本"""
+        text = self.pending + text
+        self.pending = ""
+        output = []
+        while text:
+            tag = THINK_CLOSE if self.inside else THINK_OPEN
+            index = text.find(tag)
+            if index >= 0:
+                if not self.inside:
+                    output.append(text[:index])
+                text = text[index + len(tag):]
+                self.inside = not self.inside
+                continue
+            keep = _partial_tag(text, tag)
+            if not self.inside:
+                output.append(text[:len(text) - keep])
+            self.pending = text[len(text) - keep:]
+            break
+        return "".join(output)
+
+    def flush(self):
+        text = "" if self.inside else self.pending
+        self.pending = ""
+        return text
+
 
 class LLMHandler:
     def __init__(self, config):
         self.config = config
         self.history_task = []
         self.last_error = None
-        self.MAX_CHARS = 30000
+        self.history_truncations = 0    # 历史记录被截断的次数
+
+        # 历史记录的token预算和压缩状态，每条消息的token数与history_task一一对应
+        history_config = config.get('History', {})
+        self.max_history_tokens = history_config.get('max_tokens', 8000)
+        self.keep_recent = history_config.get('keep_recent', 2)   # 保留原文的最近几轮回复
+        self.history_meta = []
+        self.history_tokens = 0
+        self.token_scale = 1.0          # API实际计算的token数与本地估计值之比
+        self.screens_compacted = 0      # 此位置之前的用户消息已不含屏幕信息
+        self.replies_compacted = 0      # 此位置之前的回复已压缩为总结
+
+        # 前缀缓存友好的布局：历史记录只追加，超出预算时一次性压缩和截断到trim_ratio，
+        # 易变的屏幕信息放在最后一条消息的末尾，使各步之间相同的前缀尽可能长
+        self.prefix_cache = history_config.get('prefix_cache', False)
+        self.trim_ratio = history_config.get('trim_ratio', 0.5)
+        # 截断后的历史记录至少要容纳一次完整的屏幕信息，否则每次截断都会清空全部历史
+        screen_budget = config.get('ScreenInfo', {}).get('token_budget', 0)
+        if self.prefix_cache and screen_budget and self.max_history_tokens * self.trim_ratio < screen_budget:
+            self.trim_ratio = min(1.0, screen_budget / self.max_history_tokens)
+            print(f"History.max_tokens × trim_ratio 小于 ScreenInfo.token_budget（{screen_budget}），"
+                  f"trim_ratio 已调整为 {self.trim_ratio:.2f}")
+        self.step_usage = []            # 每一步的token用量和耗时
         
         # 初始化OpenAI客户端
         openai_config = config['OpenAI']
         self.api_key = openai_config['api_key']
         self.model = openai_config.get('model', 'deepseek-chat')
         self.base_url = openai_config.get('base_url', 'https://api.deepseek.com')
-        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+        # 流式模式下每收到一行完整的操作就交给调用者执行
+        self.stream = openai_config.get('stream', False)
+        # 工具调用模式下操作以带类型的工具调用返回，参数在执行前校验
+        self.tool_mode = openai_config.get('tool_mode', False)
+        self.actions = None             # 工具调用模式下最近一次回复中待执行的操作
+        self.tool_errors = []
+        # 连接复用、超时、退避重试和取消由传输层负责
+        self.transport = LLMTransport(openai_config)
+        # 按步骤的难度在快速模型和强模型之间选择
+        self.router = ModelRouter(config.get('Routing', {}), self.model)
+        self.failures = 0               # 连续带有错误信息的步数
+        # 重复的任务直接使用缓存的大纲
+        self.outline_cache = OutlineCache(config.get('OutlineCache', {}))
         
-        # 加载提示词
+        # 加载提示词，工具调用模式不需要在提示词中说明操作格式
         self.task_prompt_system = config['Prompts'].get('task_prompt', {}).get('system', '')
+        if self.tool_mode:
+            self.task_prompt_system = config['Prompts'].get('task_prompt_tools', {}).get('system', self.task_prompt_system)
         self.task_prompt_user = config['Prompts'].get('task_prompt', {}).get('user', '')
         self.MAX_HISTORY_RECORDS = 5
 
@@ -33,67 +124,286 @@ class LLMHandler:
         """移除响应中<think></think>标签内的内容"""
         return re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
 
+    def _append_history(self, role, content, **meta):
+        """追加一条历史消息并累加其token数"""
+        tokens = estimate_tokens(content)
+        self.history_task.append({"role": role, "content": content})
+        self.history_meta.append(dict(meta, tokens=tokens))
+        self.history_tokens += tokens
+
+    def _replace_history(self, i, content):
+        """替换一条历史消息的内容并修正token总数"""
+        tokens = estimate_tokens(content)
+        self.history_tokens += tokens - self.history_meta[i]["tokens"]
+        self.history_meta[i]["tokens"] = tokens
+        self.history_task[i] = {"role": self.history_task[i]["role"], "content": content}
+
+    def _compact_history(self):
+        """压缩历史记录
+
+        最近一次完整屏幕信息之前的用户消息只保留占位符和错误信息（之后的屏幕差异仍以它为基准）；
+        最近keep_recent轮之前的回复只保留sum()总结。每条消息只压缩一次。
+        """
+        latest_full = max((i for i, meta in enumerate(self.history_meta) if meta.get("full_screen")), default=0)
+        for i in range(self.screens_compacted, latest_full):
+            meta = self.history_meta[i]
+            if "error_info" in meta:
+                self._replace_history(i, self._user_prompt(SCREEN_PLACEHOLDER, meta["error_info"]))
+        self.screens_compacted = max(self.screens_compacted, latest_full)
+
+        recent = len(self.history_task) - 2 * self.keep_recent
+        for i in range(self.replies_compacted, recent):
+            if self.history_task[i]["role"] != "assistant":
+                continue
+            summary = self._extract_summary(self.history_task[i]["content"])
+            if summary:
+                self._replace_history(i, f"sum({summary})")
+        self.replies_compacted = max(self.replies_compacted, recent)
+
+    def _user_prompt(self, screen_info, error_info):
+        """生成用户消息，前缀缓存布局下错误信息在前、屏幕信息在最后"""
+        if self.prefix_cache:
+            return (error_info.strip() + "\n\n" if error_info else "") + self.task_prompt_user.format(screen_info=screen_info)
+        return self.task_prompt_user.format(screen_info=screen_info) + error_info
+
     def _truncate_history(self):
-        """如果总字符数超过MAX_CHARS，则截断历史记录"""
-        total_chars = sum(len(msg["content"]) for msg in self.history_task)
-        while total_chars > self.MAX_CHARS and self.history_task:
+        """压缩后仍超出token预算时，按用户-助手对从最早的记录开始移除
+
+        前缀缓存布局下，未超出预算时不改动已有的历史记录；超出时一次性压缩，
+        并截断到预算的trim_ratio，减少前缀被破坏的次数。
+        最近一次完整屏幕信息所在的一轮及其后的记录不会被移除：之后的屏幕差异都以它为基准。
+        """
+        limit = self.max_history_tokens
+        if self.prefix_cache:
+            if self.history_tokens * self.token_scale <= limit:
+                return
+            limit *= self.trim_ratio
+        self._compact_history()
+        # 最新的一轮无论如何都保留
+        keep_from = min(max((i for i, meta in enumerate(self.history_meta) if meta.get("full_screen")),
+                            default=len(self.history_task)),
+                        len(self.history_task) - 2)
+        if self.history_tokens * self.token_scale > limit and keep_from >= 2:
+            self.history_truncations += 1
+        while self.history_tokens * self.token_scale > limit and keep_from >= 2:
             # 确保历史记录按用户-助手对的方式移除
-            if len(self.history_task) >= 2:
-                total_chars -= len(self.history_task[0]["content"]) + len(self.history_task[1]["content"])
-                self.history_task = self.history_task[2:]
+            count = 2
+            keep_from -= count
+            self.history_tokens -= sum(meta["tokens"] for meta in self.history_meta[:count])
+            del self.history_task[:count]
+            del self.history_meta[:count]
+            self.screens_compacted = max(0, self.screens_compacted - count)
+            self.replies_compacted = max(0, self.replies_compacted - count)
+
+    def _update_token_scale(self, usage, estimated_tokens):
+        """用API返回的实际prompt token数校准本地估计"""
+        prompt_tokens = getattr(usage, "prompt_tokens", None) if usage else None
+        if prompt_tokens and estimated_tokens:
+            self.token_scale = 0.8 * self.token_scale + 0.2 * (prompt_tokens / estimated_tokens)
+            debug_print(f"prompt token数: {prompt_tokens}，本地估计: {estimated_tokens}，校准系数: {self.token_scale:.2f}")
+
+    @staticmethod
+    def _cached_tokens(usage):
+        """从usage中读取命中前缀缓存的token数，兼容OpenAI和DeepSeek的字段"""
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) if details else None
+        if cached is None:
+            cached = getattr(usage, "prompt_cache_hit_tokens", None)
+        return cached or 0
+
+    def _record_usage(self, usage, latency, **extra):
+        """记录一步的token用量、缓存命中和耗时"""
+        record = {
+            "prompt_tokens": getattr(usage, "prompt_tokens", None) or 0,
+            "cached_tokens": self._cached_tokens(usage),
+            "completion_tokens": getattr(usage, "completion_tokens", None) or 0,
+            "latency": round(latency, 3),
+            **extra,
+        }
+        self.step_usage.append(record)
+        prompt_total = sum(step["prompt_tokens"] for step in self.step_usage)
+        cached_total = sum(step["cached_tokens"] for step in self.step_usage)
+        hit_rate = cached_total / prompt_total if prompt_total else 0
+        debug_print(f"本步token用量: {record}，累计缓存命中率: {hit_rate:.1%}")
+
+    def _tool_options(self):
+        return {"tools": TOOLS, "tool_choice": "required"} if self.tool_mode else {}
+
+    def _parse_tool_call(self, name, arguments):
+        """校验一次工具调用，有效时加入self.actions，无效时记录原因并返回None"""
+        try:
+            action = parse_tool_call(name, arguments)
+        except ValueError as e:
+            self.tool_errors.append(str(e))
+            return None
+        self.actions.append(action)
+        return action
+
+    def _tool_reply(self, content):
+        """把工具调用转换为等价的文本操作，作为历史记录中的回复"""
+        lines = [str(action) for action in self.actions]
+        if self.tool_errors:
+            lines.append(f"（无效的工具调用: {'; '.join(self.tool_errors)}）")
+        return "\n".join(lines) or self._remove_think_tags(content or "").strip()
+
+    def _stream_reply(self, model, messages, on_line, start_time, retries=None):
+        """以流式方式请求模型，每收到一行完整的（已去除<think>内容的）文本就调用on_line
+
+        工具调用模式下每个工具调用的参数接收完整后即校验，有效的操作交给on_line。
+        on_line返回False时停止接收。返回 (完整响应, usage, 首行耗时)。
+        """
+        response = self.transport.stream(
+            model=model,
+            messages=messages,
+            stream_options={"include_usage": True},
+            max_retries=retries,
+            **self._tool_options()
+        )
+        think_filter = ThinkFilter()
+        parts, usage, buffer = [], None, ""
+        calls = []                  # 工具调用模式下各调用的 [名称, 参数]
+        first_line = None
+
+        def emit(line):
+            nonlocal first_line
+            if first_line is None:
+                first_line = round(time.perf_counter() - start_time, 3)
+            return on_line(line) is not False
+
+        def emit_call(position):
+            action = self._parse_tool_call(*calls[position])
+            return action is None or action.name == "sum" or emit(action)
+
+        def reply():
+            return self._tool_reply("".join(parts)) if self.tool_mode else "".join(parts)
+
+        try:
+            for chunk in response:
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                for call in getattr(delta, "tool_calls", None) or ():
+                    # 出现下一个调用时，上一个调用的参数已经完整
+                    if call.index >= len(calls):
+                        if calls and not emit_call(len(calls) - 1):
+                            return reply(), usage, first_line
+                        calls.append(["", ""])
+                    if call.function:
+                        calls[call.index][0] += call.function.name or ""
+                        calls[call.index][1] += call.function.arguments or ""
+                text = delta.content
+                if not text:
+                    continue
+                parts.append(text)
+                if self.tool_mode:
+                    continue
+                buffer += think_filter.feed(text)
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    if not emit(line):
+                        return reply(), usage, first_line
+            if calls:
+                emit_call(len(calls) - 1)
+            buffer += think_filter.flush()
+            if buffer:
+                emit(buffer)
+        finally:
+            response.close()
+        return reply(), usage, first_line
+
+    def process_task(self, task_str, screen_info, outline, retries=None, full_screen=True, on_line=None,
+                     screen_change=0.0):
+        """使用LLM处理任务并返回响应
+
+        full_screen 表示screen_info是完整的屏幕信息而非相对上一步的差异。
+        screen_change 为屏幕相对上一步的变化比例，与连续失败次数一起决定使用的模型档位。
+        retries 为传输层的最大重试次数，None表示使用配置值。
+        流式模式下若提供on_line，响应的每一行在到达时即交给on_line执行，
+        on_line返回False时停止接收；已有操作被执行后出错时，中断信息作为下一步的错误信息。
+        """
+        streamed = {"lines": 0}
+
+        def track(line):
+            streamed["lines"] += 1
+            return on_line(line)
+
+        try:
+            # 创建当前提示词，如有错误则包含错误信息
+            error_info = f"\n\n上次操作错误信息：{self.last_error}" if self.last_error else ""
+            self.last_error = None  # 清除错误信息
+            self.actions = [] if self.tool_mode else None
+            self.tool_errors = []
+            self.failures = self.failures + 1 if error_info else 0
+            tier, model = self.router.choose(self.failures, screen_change)
+            
+            current_prompt = self._user_prompt(screen_info, error_info)
+            formatted_system_prompt = self.task_prompt_system.format(task_str=task_str, outline=outline)
+            
+            # 准备消息列表
+            messages = [
+                {"role": "system", "content": formatted_system_prompt},
+                *self.history_task,  # 添加对话历史
+                {"role": "user", "content": current_prompt}
+            ]
+            
+            # 调用API
+            start_time = time.perf_counter()
+            if self.stream and on_line:
+                llm_response, usage, first_line = self._stream_reply(model, messages, track, start_time, retries)
+                self._record_usage(usage, time.perf_counter() - start_time, tier=tier, first_line=first_line)
             else:
-                # 如果只剩一条消息，直接清空
-                total_chars -= len(self.history_task[0]["content"])
-                self.history_task = []
-                break
-
-    def process_task(self, task_str, screen_info, outline, retries=3):
-        """使用LLM处理任务并返回响应"""
-        for attempt in range(retries):
-            try:
-                # 创建当前提示词，如有错误则包含错误信息
-                error_info = f"\n\n上次操作错误信息：{self.last_error}" if self.last_error else ""
-                self.last_error = None  # 清除错误信息
-                
-                current_prompt = self.task_prompt_user.format(screen_info=screen_info) + error_info
-                formatted_system_prompt = self.task_prompt_system.format(task_str=task_str, outline=outline)
-                
-                # 准备消息列表
-                messages = [
-                    {"role": "system", "content": formatted_system_prompt},
-                    *self.history_task,  # 添加对话历史
-                    {"role": "user", "content": current_prompt}
-                ]
-                
-                # 调用API
-                response = self.client.chat.completions.create(
-                    model=self.model,
+                response = self.transport.complete(
+                    model=model,
                     messages=messages,
-                    stream=False
+                    max_retries=retries,
+                    **self._tool_options()
                 )
-                
-                # 获取并打印LLM响应
-                llm_response = response.choices[0].message.content
-                print("LLM Response:\n", llm_response)
-                
-                # 移除<think>标签内容（如果存在）
-                filtered_response = self._remove_think_tags(llm_response)
-                
-                # 更新历史记录
-                self.history_task.extend([
-                    {"role": "user", "content": current_prompt},
-                    {"role": "assistant", "content": filtered_response}
-                ])
-                
-                # 需要时截断历史记录
-                self._truncate_history()
-                
-                return filtered_response
-                
-            except Exception as e:
-                print(f"LLM处理错误: {e}")
-                if attempt == retries - 1:
-                    return None
+                usage = getattr(response, "usage", None)
+                self._record_usage(usage, time.perf_counter() - start_time, tier=tier)
+                message = response.choices[0].message
+                llm_response = message.content
+                if self.tool_mode:
+                    for call in message.tool_calls or ():
+                        self._parse_tool_call(call.function.name, call.function.arguments)
+                    llm_response = self._tool_reply(message.content)
+            self.router.record(tier, time.perf_counter() - start_time)
+            debug_print(f"LLM传输统计: {self.transport.summary()}")
+            self._update_token_scale(
+                usage,
+                estimate_tokens(formatted_system_prompt) + self.history_tokens + estimate_tokens(current_prompt))
+
+            # 打印LLM响应
+            print("LLM Response:\n", llm_response)
+            
+            # 移除<think>标签内容（如果存在）
+            filtered_response = self._remove_think_tags(llm_response)
+            
+            # 更新历史记录
+            self._append_history("user", current_prompt, full_screen=full_screen, error_info=error_info)
+            self._append_history("assistant", filtered_response)
+            
+            # 压缩历史记录，需要时截断
+            self._truncate_history()
+            
+            # 无效的工具调用不执行，原因作为下一步的错误信息
+            if self.tool_errors:
+                self.set_last_error("工具调用无效: " + "; ".join(self.tool_errors))
+            if self.actions is not None:
+                self.actions = [action for action in self.actions if action.name != "sum"]
+            
+            return filtered_response
+            
+        except RequestCancelled:
+            print("LLM请求已取消")
+            return None
+        except Exception as e:
+            print(f"LLM处理错误: {e}")
+            if streamed["lines"]:
+                # 部分操作已经执行，下一步由模型根据新的屏幕信息继续
+                self.set_last_error(f"模型响应在执行了{streamed['lines']}行后中断: {e}")
+            return None
 
     def generate_outline(self, user_input):
         """使用LLM生成任务大纲"""
@@ -109,17 +419,28 @@ class LLMHandler:
                 {"role": "user", "content": user_prompt}
             ]
             
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages, # type: ignore
-                stream=False
-            ) # type: ignore
+            tier, model = self.router.choose_outline()
+            version = prompt_version(outline_prompt_system, outline_prompt_user)
+            cached = self.outline_cache.get(user_input, model, version)
+            if cached is not None:
+                debug_print(f"使用缓存的大纲，缓存统计: {self.outline_cache.stats}")
+                return cached
+            start_time = time.perf_counter()
+            response = self.transport.complete(
+                model=model,
+                messages=messages
+            )
+            self.router.record(tier, time.perf_counter() - start_time)
             
             response_content = response.choices[0].message.content.strip()
             # 移除<think>标签内容
             filtered_response = self._remove_think_tags(response_content)
+            self.outline_cache.put(user_input, model, version, filtered_response)
             
             return filtered_response
+        except RequestCancelled:
+            print("生成大纲的请求已取消")
+            return None
         except Exception as e:
             print(f"生成大纲时发生错误: {e}")
             return None
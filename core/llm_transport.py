@@ -0,0 +1,338 @@
+import asyncio
+import bisect
+import concurrent.futures
+import queue
+import random
+import threading
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from .debug import debug_print
+
+
+class RequestCancelled(Exception):
+    """请求被cancel_all取消"""
+
+
+_STREAM_END = object()
+
+
+class ChunkStream:
+    """把后台事件循环中的流式响应转换为同步迭代器
+
+    后台协程持续把分块放入队列，调用者处理分块（例如执行操作）时不会阻塞接收。
+    """
+
+    def __init__(self, chunks, future):
+        self.chunks = chunks
+        self.future = future
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is _STREAM_END:
+                break
+            yield chunk
+        if self.future.cancelled():
+            raise RequestCancelled("请求已取消")
+        error = self.future.exception()
+        if error:
+            raise error
+
+    def close(self):
+        self.future.cancel()
+
+
+class LatencyHistogram:
+    """按对数间隔分桶的延迟直方图，用于估计延迟的百分位数"""
+
+    # 桶的上界（秒），约每档增加25%
+    BOUNDS = [0.05 * 1.25 ** i for i in range(40)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += 1
+
+    def percentile(self, fraction):
+        """返回不小于fraction比例样本的桶上界，没有样本时返回None"""
+        if not self.total:
+            return None
+        target = fraction * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.BOUNDS[min(index, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+
+class Endpoint:
+    """一个OpenAI兼容的服务地址及其连接池和延迟统计"""
+
+    def __init__(self, client, base_url):
+        self.client = client
+        self.base_url = base_url
+        # 非流式请求记录完整响应的耗时，流式请求记录首个分块的耗时
+        self.histograms = {False: LatencyHistogram(), True: LatencyHistogram()}
+        self.failures = 0           # 连续失败次数
+        self.stats = {"requests": 0, "wins": 0, "errors": 0, "cancelled": 0}
+
+
+class LLMTransport:
+    """在后台线程的事件循环中发送请求的OpenAI兼容传输层
+
+    每个服务地址使用一个保持连接的HTTP连接池；每次请求有超时限制；
+    超时、连接错误、429和5xx响应按指数退避加随机抖动重试，
+    服务端给出Retry-After时以其为准。cancel_all可从任意线程立即取消所有进行中的请求。
+
+    配置了多个服务地址（endpoints）时发送对冲请求：首选地址在其历史延迟的
+    hedge_percentile百分位内没有返回响应（流式请求为首个分块）时，向下一个地址再发一次，
+    先成功的结果被采用，另一个请求被取消。
+    """
+
+    def __init__(self, config):
+        self.timeout = config.get('timeout', 60)                # 每次请求的超时时间（秒）
+        self.max_retries = config.get('max_retries', 3)
+        self.backoff_base = config.get('backoff_base', 1.0)     # 第一次重试前的平均等待时间（秒）
+        self.backoff_max = config.get('backoff_max', 30.0)
+        hedge_config = config.get('hedge', {})
+        self.hedge_percentile = hedge_config.get('percentile', 0.9)
+        self.hedge_min_samples = hedge_config.get('min_samples', 10)
+        self.hedge_delay = hedge_config.get('default_delay', 5.0)   # 样本不足时使用的对冲等待时间
+        self.hedge_min_delay = hedge_config.get('min_delay', 0.5)
+        self.hedge_max_delay = hedge_config.get('max_delay', 30.0)
+        self.stats = {"requests": 0, "retries": 0, "timeouts": 0, "cancelled": 0, "hedged": 0, "hedge_wins": 0}
+        self.futures = set()
+        self.lock = threading.Lock()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        # 未配置endpoints时使用base_url和api_key作为唯一的服务地址
+        endpoints = config.get('endpoints') or [{}]
+        self.endpoints = [self._run(self._create_endpoint(config, endpoint)) for endpoint in endpoints]
+
+    async def _create_endpoint(self, config, endpoint):
+        # 在事件循环中创建客户端，连接池绑定到该循环
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config.get('max_connections', 4),
+                max_keepalive_connections=config.get('max_connections', 4),
+                keepalive_expiry=config.get('keepalive', 60)),
+            timeout=httpx.Timeout(self.timeout, connect=min(10, self.timeout)))
+        base_url = endpoint.get('base_url') or config.get('base_url', 'https://api.deepseek.com')
+        client = AsyncOpenAI(
+            api_key=endpoint.get('api_key') or config['api_key'],
+            base_url=base_url,
+            max_retries=0,      # 由本类负责重试
+            http_client=http_client)
+        return Endpoint(client, base_url)
+
+    def _submit(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def _run(self, coroutine):
+        future = self._submit(coroutine)
+        try:
+            return future.result()
+        except (concurrent.futures.CancelledError, asyncio.CancelledError):
+            raise RequestCancelled("请求已取消")
+
+    def retry_delay(self, error, attempt):
+        """返回第attempt次失败后重试前的等待时间（attempt从0开始），不应重试的错误返回None"""
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code != 429 and error.status_code < 500:
+                return None
+            retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+            try:
+                if retry_after is not None:
+                    return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        elif not isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError)):
+            return None
+        # 指数退避，在上限的一半到全部之间随机取值，避免多个客户端同时重试
+        ceiling = min(self.backoff_max, self.backoff_base * 2 ** (attempt + 1))
+        return random.uniform(ceiling / 2, ceiling)
+
+    async def _with_retry(self, make_request, max_retries=None):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            self.stats["requests"] += 1
+            try:
+                return await asyncio.wait_for(make_request(), self.timeout)
+            except asyncio.CancelledError:
+                self.stats["cancelled"] += 1
+                raise
+            except Exception as e:
+                if isinstance(e, (asyncio.TimeoutError, openai.APITimeoutError)):
+                    self.stats["timeouts"] += 1
+                delay = self.retry_delay(e, attempt) if attempt < max_retries else None
+                if delay is None:
+                    raise
+                attempt += 1
+                self.stats["retries"] += 1
+                debug_print(f"LLM请求失败（{type(e).__name__}: {e}），{delay:.1f}秒后第{attempt}次重试")
+                await asyncio.sleep(delay)
+
+    def hedge_delay_for(self, endpoint, stream):
+        """根据地址的延迟直方图计算发送对冲请求前的等待时间"""
+        histogram = endpoint.histograms[stream]
+        delay = self.hedge_delay
+        if histogram.total >= self.hedge_min_samples:
+            delay = histogram.percentile(self.hedge_percentile)
+        return min(max(delay, self.hedge_min_delay), self.hedge_max_delay)
+
+    async def _attempt(self, endpoint, stream, kwargs):
+        """向一个地址发送请求；流式请求等到首个分块，返回 (响应, 分块迭代器, 首个分块)"""
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        endpoint.stats["requests"] += 1
+        response = None
+        try:
+            response = await endpoint.client.chat.completions.create(stream=stream, **kwargs)
+            iterator = first = None
+            if stream:
+                iterator = response.__aiter__()
+                try:
+                    first = await iterator.__anext__()
+                except StopAsyncIteration:
+                    pass
+        except asyncio.CancelledError:
+            endpoint.stats["cancelled"] += 1
+            if stream and response is not None:
+                await response.close()
+            raise
+        except Exception:
+            endpoint.failures += 1
+            endpoint.stats["errors"] += 1
+            raise
+        endpoint.failures = 0
+        endpoint.histograms[stream].add(loop.time() - start_time)
+        return response, iterator, first
+
+    async def _hedged(self, stream, kwargs):
+        """发送请求，必要时向下一个地址发送对冲请求，返回最先成功的结果"""
+        # 连续失败次数少的地址优先，相同时按配置顺序
+        order = sorted(self.endpoints, key=lambda endpoint: endpoint.failures)
+        primary = order[0]
+        pending = {}
+
+        def launch():
+            endpoint = order.pop(0)
+            pending[asyncio.ensure_future(self._attempt(endpoint, stream, kwargs))] = endpoint
+
+        launch()
+        error = None
+        try:
+            while pending:
+                # 只有一个请求在进行且还有备用地址时，最多等待对冲延迟
+                delay = None
+                if len(pending) == 1 and order:
+                    delay = self.hedge_delay_for(next(iter(pending.values())), stream)
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.stats["hedged"] += 1
+                    launch()
+                    continue
+                winner = None
+                for task in done:
+                    endpoint = pending.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = endpoint, task.result()
+                    elif stream:
+                        # 同时完成的另一个流式响应不再使用
+                        await task.result()[0].close()
+                if winner:
+                    endpoint, result = winner
+                    endpoint.stats["wins"] += 1
+                    if endpoint is not primary:
+                        self.stats["hedge_wins"] += 1
+                    return result
+                # 全部失败且错误值得重试时，立即改用下一个地址
+                if not pending and order and self.retry_delay(error, 0) is not None:
+                    launch()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def complete(self, max_retries=None, **kwargs):
+        """发送非流式请求，返回完整响应"""
+
+        async def request():
+            response, _, _ = await self._hedged(False, kwargs)
+            return response
+
+        return self._run(self._with_retry(request, max_retries))
+
+    def stream(self, max_retries=None, **kwargs):
+        """发送流式请求，返回ChunkStream
+
+        只有在收到响应之前的失败会重试，收到分块之后的错误在迭代时抛出。
+        """
+        chunks = queue.Queue()
+
+        async def pump():
+            response, iterator, first = await self._with_retry(lambda: self._hedged(True, kwargs), max_retries)
+            try:
+                if first is not None:
+                    chunks.put(first)
+                async for chunk in iterator:
+                    chunks.put(chunk)
+            except asyncio.CancelledError:
+                self.stats["cancelled"] += 1
+                raise
+            finally:
+                await response.close()
+
+        future = self._submit(pump())
+        future.add_done_callback(lambda _: chunks.put(_STREAM_END))
+        return ChunkStream(chunks, future)
+
+    def summary(self):
+        """传输层和各服务地址的统计，包括延迟的中位数和对冲百分位数"""
+        summary = dict(self.stats)
+        for endpoint in self.endpoints:
+            latency = {}
+            for stream, histogram in endpoint.histograms.items():
+                if histogram.total:
+                    latency["first_chunk" if stream else "response"] = (
+                        round(histogram.percentile(0.5), 2), round(histogram.percentile(self.hedge_percentile), 2))
+            summary[endpoint.base_url] = dict(endpoint.stats, latency=latency)
+        return summary
+
+    def cancel_all(self):
+        """取消所有进行中的请求，等待结果的调用者收到RequestCancelled"""
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.cancel()
+
+    def close(self):
+        self.cancel_all()
+        try:
+            for endpoint in self.endpoints:
+                self._run(endpoint.client.close())
+            # 被取消的对冲请求可能留下未结束的异步生成器，在停止事件循环前收尾
+            self._run(self.loop.shutdown_asyncgens())
+        except Exception as e:
+            print(f"关闭LLM连接时发生错误: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,69 @@
+from .debug import debug_print
+
+FAST = "fast"
+STRONG = "strong"
+
+
+class ModelRouter:
+    """按调用的难度在模型档位之间选择
+
+    常规步骤使用快速模型；生成大纲、连续失败达到escalate_after_failures次、
+    或屏幕变化比例超过screen_change_ratio时升级到强模型。
+    未配置某一档位时使用OpenAI.model。
+    """
+
+    def __init__(self, config, default_model):
+        self.enabled = config.get('enabled', False)
+        self.models = {
+            FAST: (self.enabled and config.get('fast_model')) or default_model,
+            STRONG: (self.enabled and config.get('strong_model')) or default_model,
+        }
+        self.escalate_after_failures = config.get('escalate_after_failures', 1)
+        self.screen_change_ratio = config.get('screen_change_ratio', 0.6)
+        self.outline_tier = config.get('outline_tier', STRONG)
+        self.stats = {tier: {"calls": 0, "latency": 0.0} for tier in self.models}
+        self.steps = 0
+        self.escalations = {}       # 升级原因 -> 次数
+
+    def choose(self, failures=0, screen_change=0.0):
+        """为一个步骤选择档位，返回 (档位, 模型名)
+
+        failures 为连续失败的步数，screen_change 为屏幕信息的变化比例（0到1）。
+        """
+        self.steps += 1
+        tier, reason = FAST, None
+        if not self.enabled:
+            tier = STRONG
+        elif failures >= self.escalate_after_failures > 0:
+            tier, reason = STRONG, "failures"
+        elif screen_change >= self.screen_change_ratio:
+            tier, reason = STRONG, "screen_change"
+        if reason:
+            self.escalations[reason] = self.escalations.get(reason, 0) + 1
+        return tier, self.models[tier]
+
+    def choose_outline(self):
+        tier = self.outline_tier if self.enabled else STRONG
+        return tier, self.models[tier]
+
+    def record(self, tier, latency):
+        """记录一次调用的耗时"""
+        stats = self.stats[tier]
+        stats["calls"] += 1
+        stats["latency"] += latency
+        debug_print(f"模型档位统计: {self.summary()}")
+
+    def summary(self):
+        """各档位的调用次数和平均耗时，以及步骤的升级比例"""
+        summary = {}
+        for tier, stats in self.stats.items():
+            if stats["calls"]:
+                summary[tier] = {
+                    "model": self.models[tier],
+                    "calls": stats["calls"],
+                    "avg_latency": round(stats["latency"] / stats["calls"], 3),
+                }
+        if self.steps:
+            summary["escalation_rate"] = round(sum(self.escalations.values()) / self.steps, 3)
+            summary["escalations"] = dict(self.escalations)
+        return summary
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+# 规范化任务文本时去掉的首尾标点
+_TRAILING_PUNCTUATION = "。.!！?？;；,，、 "
+
+
+def normalize_task(task_str):
+    """规范化任务文本：合并空白、忽略大小写和首尾标点，使措辞相同的任务命中同一条缓存"""
+    return re.sub(r"\s+", " ", task_str).strip().strip(_TRAILING_PUNCTUATION).lower()
+
+
+def prompt_version(*prompts):
+    """由提示词内容计算版本号，提示词修改后旧的缓存自动失效"""
+    return hashlib.sha1("\0".join(prompts).encode("utf-8")).hexdigest()[:12]
+
+
+class OutlineCache:
+    """持久化的任务大纲缓存
+
+    以 (规范化的任务文本, 模型, 提示词版本) 为键保存在JSON文件中。
+    条目超过ttl_days天后失效；条目数超过max_entries时淘汰最久未使用的条目。
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.enabled = config.get("enabled", True)
+        self.path = config.get("path", "config/outline_cache.json")
+        self.max_entries = config.get("max_entries", 200)
+        self.ttl = config.get("ttl_days", 30) * 86400
+        self.lock = threading.Lock()
+        self.entries = self._load() if self.enabled else {}
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0, "expired": 0}
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"读取大纲缓存时发生错误: {e}")
+            return {}
+
+    def _save(self):
+        # 先写入临时文件再替换，避免中断时留下不完整的文件
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"保存大纲缓存时发生错误: {e}")
+
+    @staticmethod
+    def key(task_str, model, version):
+        return hashlib.sha1(f"{normalize_task(task_str)}\0{model}\0{version}".encode("utf-8")).hexdigest()
+
+    def get(self, task_str, model, version):
+        """返回缓存的大纲，未命中或已过期时返回None"""
+        if not self.enabled:
+            return None
+        key = self.key(task_str, model, version)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now - entry["created"] > self.ttl:
+                del self.entries[key]
+                self.stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            entry["used"] = now
+            self.stats["hits"] += 1
+            self._save()
+            return entry["outline"]
+
+    def put(self, task_str, model, version, outline):
+        if not self.enabled or not outline:
+            return
+        now = time.time()
+        with self.lock:
+            self.entries[self.key(task_str, model, version)] = {
+                "task": normalize_task(task_str), "model": model,
+                "outline": outline, "created": now, "used": now,
+            }
+            # 先清除过期条目，仍超出数量上限时按最近使用时间淘汰
+            for key in [key for key, entry in self.entries.items() if now - entry["created"] > self.ttl]:
+                del self.entries[key]
+                self.stats["expired"] += 1
+            if len(self.entries) > self.max_entries:
+                oldest = sorted(self.entries, key=lambda key: self.entries[key]["used"])
+                for key in oldest[:len(self.entries) - self.max_entries]:
+                    del self.entries[key]
+                    self.stats["evicted"] += 1
+            self._save()
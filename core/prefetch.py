@@ -0,0 +1,92 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .screen_info import _init_com_thread
+
+
+class SnapshotPrefetcher:
+    """在后台预先采集下一步的屏幕信息
+
+    预取任务在单个后台线程中依次执行，因此与主线程的采集不会同时进行（take会等待其结束）；
+    新的预取会取代仍在排队的旧预取。
+    每次执行操作后调用action_executed，在此之前开始的预取结果即失效，被丢弃；
+    失效的预取仍会刷新树缓存，之后的采集只需重新获取发生变化的部分。
+    refresh只在树缓存中重新获取收到事件的窗口，不生成屏幕信息。
+    """
+
+    def __init__(self, collector, config=None):
+        config = config or {}
+        self.collector = collector
+        self.enabled = config.get("enabled", True)
+        # 模型生成期间在后台预先更新树缓存中收到事件的窗口
+        self.speculative_refresh = config.get("speculative_refresh", True) and collector.tree_cache is not None
+        self.executor = None
+        self.future = None
+        self.refresh_future = None
+        self.epoch = 0              # 已执行的操作数，用于判断预取结果是否失效
+        self.stats = {"started": 0, "used": 0, "discarded": 0, "saved_seconds": 0.0, "refreshed_windows": 0}
+
+    def action_executed(self):
+        self.epoch += 1
+
+    def _submit(self, function, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, initializer=_init_com_thread,
+                                               thread_name_prefix="SnapshotPrefetch")
+        return self.executor.submit(function, *args)
+
+    def start(self):
+        """开始一次预取，之前尚未结束的预取完成后才会开始
+
+        之前的预取仍在排队时将其取消，最多只有一次预取在排队，take不必依次等待多次采集。
+        """
+        if not self.enabled:
+            return
+        if self.future is not None and self.future.cancel():
+            self.stats["discarded"] += 1
+        self.stats["started"] += 1
+        self.future = self._submit(self._collect, self.epoch)
+
+    def refresh(self):
+        """模型生成期间的推测性刷新：只更新树缓存，不采集完整的屏幕信息"""
+        if self.enabled and self.speculative_refresh:
+            self.refresh_future = self._submit(self.collector.refresh_tree_cache)
+
+    def wait_refresh(self):
+        """等待推测性刷新结束，主线程采集之前调用，避免与后台线程同时更新树缓存"""
+        future, self.refresh_future = self.refresh_future, None
+        if future is None:
+            return
+        try:
+            self.stats["refreshed_windows"] += future.result()
+        except Exception as e:
+            print(f"刷新树缓存时发生错误: {e}")
+
+    def _collect(self, epoch):
+        start_time = time.perf_counter()
+        screen_info = self.collector.get_screen_info()
+        return epoch, screen_info, self.collector.optable, time.perf_counter() - start_time
+
+    def take(self):
+        """等待后台预取结束，返回仍然有效的 (屏幕信息, 操作表)，没有或已失效时返回None"""
+        self.wait_refresh()
+        future, self.future = self.future, None
+        if future is None:
+            return None
+        wait_start = time.perf_counter()
+        try:
+            epoch, screen_info, optable, elapsed = future.result()
+        except Exception as e:
+            print(f"预取屏幕信息时发生错误: {e}")
+            return None
+        if epoch != self.epoch:
+            self.stats["discarded"] += 1
+            return None
+        self.stats["used"] += 1
+        # 预取耗时中与其他阶段重叠、主线程不必再等待的部分
+        self.stats["saved_seconds"] += max(0.0, elapsed - (time.perf_counter() - wait_start))
+        return screen_info, optable
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
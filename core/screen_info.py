@@ -1,215 +1,947 @@
+from array import array
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Optional
+import sys
 import uiautomation as auto
-import psutil
 import json
 import os
-import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from .debug import debug_print
+from .window_policy import WindowPolicy, WindowPolicies, WindowMatcher
+from .element_ids import StableIdRegistry
+from . import compact_format
+from .token_budget import TokenBudget, HIDDEN, INTERACTIVE_TYPES
+from .window_meta import WindowMetaCache, WINDOW_VISIBLE, WINDOW_MINIMIZED
+from .tree_cache import (UITreeCache, UIAEventProvider, UIA_RuntimeIdPropertyId, UIA_NamePropertyId,
+                         UIA_ControlTypePropertyId, UIA_IsEnabledPropertyId,
+                         UIA_SelectionItemIsSelectedPropertyId, UIA_ToggleToggleStatePropertyId)
 
-@dataclass
+# CacheRequest模式下一次性获取的属性
+CACHED_PROPERTIES = [
+    UIA_RuntimeIdPropertyId,
+    UIA_NamePropertyId,
+    UIA_ControlTypePropertyId,
+    UIA_IsEnabledPropertyId,
+    UIA_SelectionItemIsSelectedPropertyId,
+    UIA_ToggleToggleStatePropertyId,
+]
+
+# 通过TextPattern读取有限长度文本的控件类型
+BOUNDED_TEXT_TYPES = ("DocumentControl",)
+# 文本被截断时追加的标记，提示还有更多内容
+TRUNCATION_MARK = "…(已截断)"
+# 元素树可能包含数十万个节点，Python 3.10及以上使用__slots__减少每个节点的内存
+DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+_com_thread_state = threading.local()
+
+def _init_com_thread():
+    """采集线程池的初始化函数，为每个工作线程初始化COM"""
+    _com_thread_state.initializer = auto.UIAutomationInitializerInThread()
+
+@dataclass(**DATACLASS_SLOTS)
 class ElementInfo:
     item: auto.Control
     name: str = ""
     children: List['ElementInfo'] = field(default_factory=list)
     window_title: str = ""
     index: int = 0
+    runtime_id: tuple = ()
+    # 以下字段在CacheRequest模式下由缓存属性填充，为None时读取实时属性
+    cached_type: str = ""
+    cached_enabled: Optional[bool] = None
+    cached_selected: Optional[bool] = None
+    cached_toggle_state: Optional[int] = None
+    # 超出快照深度而未展开的子元素个数，大于0表示该元素已折叠
+    collapsed_children: int = 0
+    depth: int = 0
+    # 子树因达到控件数量上限而未采集完整
+    truncated: bool = False
+    # 因控件类型不允许而被略去、子元素由本元素接管的后代的RuntimeId
+    spliced_ids: tuple = ()
     
     @property
     def type(self):
-        return self.item.ControlTypeName
+        return self.cached_type or self.item.ControlTypeName
+
+    @property
+    def is_enabled(self):
+        if self.cached_enabled is not None:
+            return self.cached_enabled
+        return self.item.IsEnabled
+
+    @property
+    def is_selected(self):
+        if self.cached_selected is not None:
+            return self.cached_selected
+        return self.item.GetSelectionItemPattern().IsSelected
+
+    @property
+    def toggle_state(self):
+        if self.cached_type:
+            return self.cached_toggle_state
+        togglePattern = self.item.GetPattern(auto.PatternId.TogglePattern)
+        return togglePattern.ToggleState if togglePattern else None
+
+class ElementTable:
+    """屏幕信息中可操作元素的查找表，按元素编号直接寻址
+
+    每个字段保存在单独的列表（数值字段使用array）中，不为每个元素创建对象；
+    元素编号是从0开始的连续整数，rows 以编号为下标记录所在的行，查找为O(1)。
+    只保存已输出元素的控件引用，不会输出的元素不进入此表。
+    """
+    __slots__ = ("rows", "indexes", "items", "names", "window_titles", "runtime_ids", "types", "collapsed")
+
+    def __init__(self):
+        self.rows = array("l")          # 元素编号 -> 行号，-1表示该编号不在表中
+        self.indexes = array("l")
+        self.items = []
+        self.names = []
+        self.window_titles = []
+        self.runtime_ids = []
+        self.types = []
+        self.collapsed = array("l")     # 已折叠的子元素个数
+
+    def append(self, index, item, name, window_title, runtime_id, control_type, collapsed_children=0):
+        if index >= len(self.rows):
+            self.rows.extend([-1] * (index + 1 - len(self.rows)))
+        self.rows[index] = len(self.indexes)
+        self.indexes.append(index)
+        self.items.append(item)
+        self.names.append(name)
+        self.window_titles.append(window_title)
+        self.runtime_ids.append(runtime_id)
+        self.types.append(control_type)
+        self.collapsed.append(collapsed_children)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def _row(self, index):
+        if 0 <= index < len(self.rows):
+            row = self.rows[index]
+            if row >= 0:
+                return row
+        return None
+
+    def __contains__(self, index):
+        return self._row(index) is not None
+
+    def item(self, index):
+        """返回编号对应的控件，编号不存在时返回None"""
+        row = self._row(index)
+        return None if row is None else self.items[row]
+
+    def get(self, index):
+        """返回编号对应元素的ElementInfo，编号不存在时返回None"""
+        row = self._row(index)
+        return None if row is None else self._element_info(row)
+
+    def __iter__(self):
+        for row in range(len(self.indexes)):
+            yield self._element_info(row)
+
+    def _element_info(self, row):
+        return ElementInfo(
+            item=self.items[row],
+            name=self.names[row],
+            window_title=self.window_titles[row],
+            index=self.indexes[row],
+            runtime_id=self.runtime_ids[row],
+            cached_type=self.types[row],
+            collapsed_children=self.collapsed[row],
+        )
+
 
 class ScreenInfoCollector:
-    def __init__(self, max_text_length=500):
+    def __init__(self, max_text_length=500, config=None, tree_cache=None):
+        self.config = config or {}
         self.elements = []
-        self.optable = []
-        self.g_index = 0
+        self.optable = ElementTable()
+        self.last_signature = None      # 最近一次快照开始时的窗口签名
+        self.element_ids = StableIdRegistry()   # 同一任务内保持不变的元素编号
         self.result = ""
         self.max_text_length = max_text_length
-        self.excluded_windows = self.load_excluded_windows()
+        self.stats = {}
+        # 屏幕信息格式：default 为每行 "编号 (类型) 名称"；compact 为带缩进和字典编码的紧凑格式
+        self.output_format = self.config.get("format", "default")
+        self.used_types = set()
+        # 记录每次快照的元素树，供core.bench比较不同格式的token数
+        self.record_dir = self.config.get("record_dir", "")
+        # 使用CacheRequest一次性获取整个子树及其属性
+        self.use_cache_request = self.config.get("use_cache_request", False)
+
+        # 并行采集窗口的线程池，collect_workers不大于1时逐个窗口采集
+        self.collect_workers = self.config.get("collect_workers", 1)
+        self.window_timeout = self.config.get("window_timeout", 5)
+        self.executor = None
+        self.running_windows = {}   # 窗口句柄 -> 仍在采集中的任务
+
+        # 快照深度限制，0表示不限制；超出深度的容器折叠显示，可通过expand展开
+        self.max_depth = self.config.get("max_depth", 0)
+        self.expanded = set()       # 已展开元素的RuntimeId
+
+        # 窗口排除列表和按窗口的采集策略
+        exwindows = self.load_exwindows()
+        self.excluded_windows = [WindowMatcher(rule) for rule in exwindows.get("excluded_windows", [])]
+        self.window_policies = WindowPolicies(exwindows, default_max_depth=self.max_depth)
+        self.default_policy = WindowPolicy(max_depth=self.max_depth)
+        self.window_meta = WindowMetaCache()
+
+        # 屏幕信息的token预算，0表示不限制；超出预算时按重要性折叠窗口或子树
+        self.token_budget = None
+        if self.config.get("token_budget", 0):
+            self.token_budget = TokenBudget(self.config["token_budget"], self.max_text_length)
+
+        # 基于UI自动化事件的增量树缓存
+        self.tree_cache = tree_cache
+        if self.tree_cache is None and self.config.get("tree_cache", False):
+            self.tree_cache = UITreeCache(UIAEventProvider(), max_age=self.config.get("tree_cache_max_age", 30))
 
-    def load_excluded_windows(self):
-        """加载需要从屏幕信息收集中排除的窗口列表"""
+    def load_exwindows(self):
+        """加载窗口排除列表和窗口采集策略"""
         try:
             if os.path.exists("config/exwindows.json"):
                 with open("config/exwindows.json", "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    return data.get("excluded_windows", [])
-            return []
+                    return json.load(f)
+            return {}
         except Exception as e:
             print(f"加载排除窗口列表失败: {str(e)}")
-            return []
+            return {}
 
     def is_window_excluded(self, window_title, window_process_name):
         """检查窗口是否应该被排除在收集范围外"""
-        for exclusion in self.excluded_windows:
-            try:
-                title_match = False
-                process_match = False
-                title_pattern = exclusion.get("title_pattern", "")
-                process_pattern = exclusion.get("process_pattern", "")
-                if title_pattern:
-                    title_match = re.search(title_pattern, window_title)
-                if process_pattern:
-                    process_match = re.search(process_pattern, window_process_name)
-                if title_match or process_match:
-                    debug_print(f"排除窗口: {window_title} {window_process_name}")
-                    return True
-            except re.error:
-                continue
+        for matcher in self.excluded_windows:
+            if matcher.matches(window_title, window_process_name):
+                debug_print(f"排除窗口: {window_title} {window_process_name}")
+                return True
         return False
 
-    def get_window_process_name(self, window):
-        """获取窗口的进程名称"""
+    def begin_task(self):
+        """开始新任务时清除上一个任务展开的元素和元素编号"""
+        self.expanded.clear()
+        self.element_ids.reset()
+
+    def set_task_context(self, text):
+        """设置任务和大纲文本，用于在token预算内优先保留相关的控件"""
+        if self.token_budget:
+            self.token_budget.set_context(text)
+
+    def get_focused_runtime_id(self):
+        """返回拥有键盘焦点的控件的RuntimeId，获取失败时返回None"""
         try:
-            pid = window.ProcessId if window else 0
-            process = psutil.Process(pid)
-            return process.name()
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess) as e:
-            print(f"获取进程名称时出错: {e}")
-            return "未知"
-
-    def collect_elements(self, element, elements_list=None):
-        """递归收集所有UI元素"""
-        if elements_list is None:
-            elements_list = []
-        
-        window = element.GetTopLevelControl()
-        window_title = window.Name if window else ""
-        
+            focused = auto.GetFocusedControl()
+            return tuple(focused.GetRuntimeId()) if focused else None
+        except Exception as e:
+            debug_print(f"获取焦点控件失败: {e}")
+            return None
+
+    def window_signature(self):
+        """顶层窗口（句柄、状态、标题）、前台窗口和焦点控件组成的签名"""
+        windows = auto.WindowControl(searchDepth=1).GetParentControl().GetChildren() # type: ignore
+        signature = []
+        for window in windows:
+            handle = window.NativeWindowHandle
+            state = self.window_meta.window_state(handle)
+            if state in (WINDOW_VISIBLE, WINDOW_MINIMIZED):
+                signature.append((handle, state, window.Name))
+        return tuple(signature), auto.GetForegroundWindow(), self.get_focused_runtime_id()
+
+    def signature_changed(self):
+        """顶层窗口签名是否与最近一次快照开始时不同，无法判断时返回True"""
+        if self.last_signature is None:
+            return True
+        try:
+            return self.window_signature() != self.last_signature
+        except Exception as e:
+            debug_print(f"计算窗口签名失败: {e}")
+            return True
+
+    def snapshot_unchanged(self):
+        """不采集元素树，廉价地判断屏幕是否与最近一次快照相同
+
+        需要树缓存的事件订阅：窗口签名相同、已缓存的窗口中没有收到变化事件且缓存都未超过max_age时视为相同。
+        没有树缓存时无法判断，返回False。
+        """
+        if not self.tree_cache:
+            return False
+        return not self.signature_changed() and not self.tree_cache.has_changes()
+
+    def child_depth(self, element_info, depth, policy):
+        """返回子元素的深度，子元素超出快照深度时返回None
+
+        已展开的元素重新从深度0开始计算，使其子树再显示若干层。
+        """
+        depth_limit = policy.depth_limit()
+        if depth_limit is None or depth < depth_limit:
+            return depth + 1
+        if not element_info.runtime_id:
+            element_info.runtime_id = tuple(element_info.item.GetRuntimeId())
+        if element_info.runtime_id in self.expanded:
+            return 1
+        return None
+
+    def count_children(self, element):
+        """统计控件的直接子元素个数，不创建子控件对象"""
+        return self.count_element_children(element.Element)
+
+    @staticmethod
+    def count_element_children(uia_element):
+        client = auto._AutomationClient.instance()
+        children = uia_element.FindAll(auto.TreeScope.Children, client.IUIAutomation.CreateTrueCondition())
+        return children.Length if children else 0
+
+    def walk_elements(self, root, make_info, get_children, count_children, depth, policy):
+        """先序遍历控件树并构建ElementInfo树，遍历过程中执行窗口策略
+
+        make_info(原始元素) 创建ElementInfo；get_children(原始元素) 返回子元素列表；
+        count_children(原始元素) 返回子元素个数。超出深度的元素折叠，不允许的控件类型
+        不输出而由其父元素直接接管其子元素。不允许的控件同样要读取属性和子元素，也计入控件数量，
+        达到上限后立即停止遍历。
+        """
+        stack = []
+
+        def push_children(raw, element_info, parent_info, depth):
+            child_depth = self.child_depth(element_info, depth, policy)
+            if child_depth is None:
+                if parent_info is element_info:
+                    element_info.collapsed_children = count_children(raw)
+                return
+            # 逆序入栈，保证出栈顺序与子元素顺序一致
+            for child in reversed(get_children(raw)):
+                stack.append((child, parent_info, child_depth))
+
+        root_info = make_info(root)
+        root_info.depth = depth
+        push_children(root, root_info, root_info, depth)
+        count = 1
+        while stack:
+            if policy.max_elements and count >= policy.max_elements:
+                root_info.truncated = True
+                break
+            raw, parent_info, depth = stack.pop()
+            element_info = make_info(raw)
+            element_info.depth = depth
+            count += 1
+            if policy.allows(element_info.type):
+                parent_info.children.append(element_info)
+                push_children(raw, element_info, element_info, depth)
+            else:
+                # 记录在接管其子元素的祖先上，使树缓存能把该元素的事件对应到祖先
+                if element_info.runtime_id:
+                    parent_info.spliced_ids += (element_info.runtime_id,)
+                push_children(raw, element_info, parent_info, depth)
+        return root_info
+
+    def read_bounded_text(self, control, limit):
+        """通过TextPattern读取可见区域（无可见区域时取光标附近）最多limit个字符的文本
+
+        返回的文本在内容不完整时带有截断标记；控件不支持TextPattern时返回None。
+        """
+        pattern = control.GetPattern(auto.PatternId.TextPattern)
+        if not pattern:
+            return None
+        ranges = pattern.GetVisibleRanges()
+        if not ranges:
+            ranges = pattern.GetSelection()
+            for text_range in ranges:
+                # 光标处是空范围，向两侧各扩展一半长度
+                text_range.MoveEndpointByUnit(auto.TextPatternRangeEndpoint.Start, auto.TextUnit.Character, -(limit // 2))
+                text_range.MoveEndpointByUnit(auto.TextPatternRangeEndpoint.End, auto.TextUnit.Character, limit // 2)
+        if not ranges:
+            return None
+
+        parts = []
+        length = 0
+        for text_range in ranges:
+            # 多取一个字符用于判断是否超出限制
+            text = text_range.GetText(limit + 1 - length)
+            parts.append(text)
+            length += len(text)
+            if length > limit:
+                break
+        text = "".join(parts)
+
+        document_range = pattern.DocumentRange
+        partial = (length > limit or
+                   ranges[0].CompareEndpoints(auto.TextPatternRangeEndpoint.Start, document_range, auto.TextPatternRangeEndpoint.Start) > 0 or
+                   ranges[-1].CompareEndpoints(auto.TextPatternRangeEndpoint.End, document_range, auto.TextPatternRangeEndpoint.End) < 0)
+        return text[:limit] + TRUNCATION_MARK if partial else text
+
+    def bounded_name(self, control, control_type):
+        """文档类控件通过TextPattern读取有限长度的文本代替完整的Name，失败时返回None"""
+        if control_type not in BOUNDED_TEXT_TYPES:
+            return None
+        try:
+            return self.read_bounded_text(control, self.max_text_length)
+        except Exception as e:
+            debug_print(f"读取文档文本失败: {e}")
+            return None
+
+    def element_info_from_control(self, control, window_title):
+        """根据控件的实时属性创建ElementInfo"""
+        name = self.bounded_name(control, control.ControlTypeName)
         element_info = ElementInfo(
-            item=element,
-            name=element.Name,
+            item=control,
+            name=control.Name if name is None else name,
             window_title=window_title,
         )
-        elements_list.append(element_info)
-        self.elements = elements_list
-        
-        for child in element.GetChildren():
-            self.collect_elements(child, element_info.children)
+        if self.tree_cache:
+            element_info.runtime_id = tuple(control.GetRuntimeId())
+        return element_info
+
+    def collect_elements(self, element, window_title=None, depth=0, policy=None):
+        """逐个控件收集UI元素，返回只含子树根节点的列表"""
+        # 子元素与根元素属于同一顶层窗口，只在根元素处查询一次
+        if window_title is None:
+            window = element.GetTopLevelControl()
+            window_title = window.Name if window else ""
+
+        root = self.walk_elements(
+            element,
+            lambda control: self.element_info_from_control(control, window_title),
+            lambda control: control.GetChildren(),
+            self.count_children,
+            depth,
+            policy or self.default_policy,
+        )
+        return [root]
+
+    def create_cache_request(self, tree_scope):
+        """创建包含序列化所需属性的CacheRequest"""
+        client = auto._AutomationClient.instance()
+        cache_request = client.IUIAutomation.CreateCacheRequest()
+        for property_id in CACHED_PROPERTIES:
+            cache_request.AddProperty(property_id)
+        cache_request.TreeScope = tree_scope
+        # 与GetChildren使用的RawViewWalker保持一致
+        cache_request.TreeFilter = client.IUIAutomation.RawViewCondition
+        return cache_request
+
+    def element_info_from_cache(self, element, window_title):
+        """根据已缓存的属性创建ElementInfo，不产生跨进程调用"""
+        control_type = element.GetCachedPropertyValue(UIA_ControlTypePropertyId)
+        constructor = auto.ControlConstructors.get(control_type, auto.Control)
+        selected = element.GetCachedPropertyValue(UIA_SelectionItemIsSelectedPropertyId)
+        toggle_state = element.GetCachedPropertyValue(UIA_ToggleToggleStatePropertyId)
+        # 不支持的属性会返回NotSupported对象而非对应类型的值
+        element_info = ElementInfo(
+            item=constructor(element=element),
+            name=element.GetCachedPropertyValue(UIA_NamePropertyId) or "",
+            window_title=window_title,
+            runtime_id=tuple(element.GetCachedPropertyValue(UIA_RuntimeIdPropertyId) or ()),
+            cached_type=auto.ControlTypeNames.get(control_type, "Control"),
+            cached_enabled=bool(element.GetCachedPropertyValue(UIA_IsEnabledPropertyId)),
+            cached_selected=selected if isinstance(selected, bool) else False,
+            cached_toggle_state=toggle_state if isinstance(toggle_state, int) and not isinstance(toggle_state, bool) else None,
+        )
+        # Name已随缓存一并取回，文档类控件只需额外读取有限长度的可见文本
+        name = self.bounded_name(element_info.item, element_info.cached_type)
+        if name is not None:
+            element_info.name = name
+        return element_info
+
+    @staticmethod
+    def cached_children(element):
+        children = element.GetCachedChildren()
+        if not children:
+            return []
+        return [children.GetElement(i) for i in range(children.Length)]
+
+    def collect_elements_cached(self, element, window_title=None, depth=0, policy=None):
+        """使用CacheRequest获取子树及所需属性，返回子树根节点
+
+        不限制深度和数量的策略用一次Subtree范围的请求取回整个子树；
+        CacheRequest本身无法限制深度和数量，受限的策略改为逐层获取：
+        每个被遍历的元素用一次Children范围的请求取回其直接子元素，达到上限后不再请求，
+        跨进程调用次数随遍历的元素数增长，但不会取回上限以外的部分。
+        """
+        if window_title is None:
+            window = element.GetTopLevelControl()
+            window_title = window.Name if window else ""
+        policy = policy or self.default_policy
+
+        if policy.is_bounded():
+            root_element = element.Element.BuildUpdatedCache(self.create_cache_request(auto.TreeScope.Element))
+            children_request = self.create_cache_request(auto.TreeScope.Children)
+            get_children = lambda uia_element: self.cached_children(uia_element.BuildUpdatedCache(children_request))
+            count_children = self.count_element_children
+        else:
+            root_element = element.Element.BuildUpdatedCache(self.create_cache_request(auto.TreeScope.Subtree))
+            get_children = self.cached_children
+            count_children = lambda uia_element: len(self.cached_children(uia_element))
+        return self.walk_elements(
+            root_element,
+            lambda uia_element: self.element_info_from_cache(uia_element, window_title),
+            get_children,
+            count_children,
+            depth,
+            policy,
+        )
 
-        return elements_list
+    def collect_subtree(self, element, depth=0, policy=None):
+        """收集控件的子树，返回子树根节点，depth为该控件在窗口中的深度"""
+        if self.use_cache_request:
+            return self.collect_elements_cached(element, depth=depth, policy=policy)
+        return self.collect_elements(element, depth=depth, policy=policy)[0]
 
-    def get_window_elements(self, element):
-        """获取窗口中的所有元素"""
+    def expand_element(self, index, optable=None):
+        """展开已折叠的元素，下一次获取屏幕信息时将包含其子元素
+
+        optable 为编号所属的操作表，默认使用最近一次快照的操作表。
+        """
+        element_info = (optable or self.optable).get(index)
+        if element_info is None or not element_info.collapsed_children:
+            return False
+        self.expanded.add(element_info.runtime_id)
+        if self.tree_cache:
+            self.tree_cache.invalidate(element_info.runtime_id)
+        return True
+
+    def refresh_element(self, element_info):
+        """重新读取元素自身的属性，不触及子元素"""
+        if element_info.cached_type:
+            cache_request = self.create_cache_request(auto.TreeScope.Element)
+            updated = element_info.item.Element.BuildUpdatedCache(cache_request)
+            fresh = self.element_info_from_cache(updated, element_info.window_title)
+            element_info.name = fresh.name
+            element_info.cached_enabled = fresh.cached_enabled
+            element_info.cached_selected = fresh.cached_selected
+            element_info.cached_toggle_state = fresh.cached_toggle_state
+        else:
+            item = element_info.item
+            name = self.bounded_name(item, item.ControlTypeName)
+            element_info.name = item.Name if name is None else name
+
+    def get_window_tree(self, element, window_id=None, policy=None):
+        """获取窗口的元素树，返回元素列表"""
+        policy = policy or self.default_policy
+
+        def collect(control, depth):
+            return self.collect_subtree(control, depth, policy)
+
+        if self.tree_cache:
+            if window_id is None:
+                window_id = tuple(element.GetRuntimeId())
+            return [self.tree_cache.get(window_id, element, collect, self.refresh_element, policy)]
+        return [collect(element, 0)]
+
+    def refresh_tree_cache(self):
+        """只在树缓存中重新获取收到变化事件的窗口，不序列化也不做token预算
+
+        用于模型生成期间的推测性刷新，之后的快照可直接使用已更新的缓存。返回刷新的窗口数。
+        """
+        if not self.tree_cache:
+            return 0
+        refreshed = 0
+        for handle, window_id, policy in self.tree_cache.begin_refresh():
+            try:
+                window = auto.ControlFromHandle(handle)
+                if window:
+                    self.get_window_tree(window, window_id, policy)
+                    refreshed += 1
+            except Exception as e:
+                debug_print(f"刷新窗口缓存失败: {e}")
+        return refreshed
+
+    def _collect_window_task(self, task):
+        """在工作线程中采集单个窗口"""
+        task["started"] = time.perf_counter()
+        return self.get_window_tree(task["window"], task["window_id"], task["policy"])
+
+    def _wait_window_task(self, task, deadline):
+        """等待窗口采集完成，超时返回None
+
+        已开始的任务从开始采集起计时；尚未开始的任务共用本次快照的截止时间deadline，
+        线程池饱和时排队的窗口不会各自再等待一个完整的window_timeout。
+        """
+        while True:
+            try:
+                return task["future"].result(timeout=0.05)
+            except FutureTimeoutError:
+                now = time.perf_counter()
+                started = task["started"]
+                if now > (started + self.window_timeout if started else deadline):
+                    task["future"].cancel()
+                    return None
+
+    def collect_window_trees(self, targets):
+        """获取各窗口的元素树，按传入顺序返回
+
+        targets 为 (窗口, 窗口RuntimeId, 采集策略) 列表。返回列表中超时的窗口对应None，
+        采集出错的窗口对应异常对象。
+        """
+        results = []
+        if self.collect_workers <= 1:
+            for window, window_id, policy in targets:
+                try:
+                    results.append(self.get_window_tree(window, window_id, policy))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        for handle in [h for h, task in self.running_windows.items() if task["future"].done()]:
+            del self.running_windows[handle]
+        hung = sum(1 for task in self.running_windows.values() if task["executor"] is self.executor)
+        if self.executor is not None and hung >= self.collect_workers:
+            # 所有工作线程都卡在之前超时的窗口上，放弃这个线程池，卡住的线程在调用返回后自行结束；
+            # 这些窗口仍记录在running_windows中，结束之前不会重复提交
+            debug_print(f"{hung}个窗口的采集仍未结束，重新创建采集线程池")
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.collect_workers,
+                                               initializer=_init_com_thread,
+                                               thread_name_prefix="ScreenCollector")
+
+        tasks = []
+        for window, window_id, policy in targets:
+            handle = window.NativeWindowHandle
+            if handle in self.running_windows:
+                # 该窗口在之前的快照中采集超时且仍未结束，不再重复提交
+                tasks.append(None)
+                continue
+            task = {"window": window, "window_id": window_id, "policy": policy, "started": None,
+                    "executor": self.executor}
+            task["future"] = self.executor.submit(self._collect_window_task, task)
+            self.running_windows[handle] = task
+            tasks.append(task)
+
+        deadline = time.perf_counter() + self.window_timeout
+        for task in tasks:
+            if task is None:
+                results.append(None)
+                continue
+            try:
+                results.append(self._wait_window_task(task, deadline))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def get_window_elements(self, element, window_id=None, elements=None, collapsed=None):
+        """获取窗口中的所有元素，collapsed为因token预算而折叠的元素 {id(元素): 子元素个数}"""
         self.result = ""
         #debug_print("#get_window_elements" + " " + element.Name)
-        self.elements = self.collect_elements(element)
+        if elements is None:
+            elements = self.get_window_tree(element, window_id)
+        self.elements = elements
         #debug_print("#collect_elements done")
 
-        def process_elements(elements_list, indent=0):
-            i = -1
-            while i < len(elements_list):
-                i += 1
-                if i >= len(elements_list):
-                    break
-            
-                # 处理嵌套的组控件
-                if elements_list[i].type == "GroupControl" and len(elements_list[i].children) == 0:
-                    elements_list.pop(i)
-                    i -= 1
-                    continue
+        scope = ("window", element.NativeWindowHandle) if element is not None else None
+        if self.output_format == "compact":
+            self.result = self.render_compact(self.elements, scope, collapsed).rstrip()
+        else:
+            self.result = "".join(self.iter_lines(self.elements, scope, collapsed)).rstrip()
+        return self.result
 
-                # 处理嵌套的文本控件，限制最大字数
-                if elements_list[i].type == "TextControl":
-                    j = i + 1
-                    # 先合并所有连续的文本控件
-                    while j < len(elements_list) and elements_list[j].type == "TextControl":
-                        elements_list[i].name += elements_list[j].name
-                        elements_list.pop(j)
-                    
-                    # 合并完成后检查长度，如果超过限制则截断
-                    if len(elements_list[i].name) > self.max_text_length:
-                        elements_list[i].name = elements_list[i].name[:self.max_text_length]
-
-                # 处理嵌套的组控件
-                while (elements_list[i].type == "GroupControl" and 
-                       len(elements_list[i].children) == 1 and
-                       elements_list[i].children[0].type != "GroupControl"):
-                    elements_list[i] = elements_list[i].children[0]
-
-                # 检查元素可见性
-                """
-                is_visible = self.is_element_visible(elements_list[i])
-                if not is_visible:
-                    continue
-                """
+    def iter_elements(self, elements_list, scope=None, collapsed=None):
+        """按输出顺序遍历元素树，产出 (元素, 显示名称, 元素编号, 折叠的子元素个数, 层级)
 
-                # 构建元素信息字符串
-                typestr = elements_list[i].type.replace('Control', '')
-                elements_list[i].index = self.g_index
-                
-                # 添加状态指示
-                status = ""
-                if "RadioButton" in typestr:
-                    selectionItemPattern = elements_list[i].item.GetSelectionItemPattern()
-                    status = " (已选中)" if selectionItemPattern.IsSelected else " (未选中)"
-
-                elif "CheckBox" in typestr:
-                    togglePattern = elements_list[i].item.GetPattern(auto.PatternId.TogglePattern)
-                    if togglePattern:
-                        state = togglePattern.ToggleState
-                        if state == auto.ToggleState.On:
-                            status = " (已选中)"
-                        elif state == auto.ToggleState.Off:
-                            status = " (未选中)"
-
-                    
-                elif "MenuItem" in typestr and not elements_list[i].item.IsEnabled:
-                    status = " (不可用)"
-                
-                line = f"{self.g_index} " + f"({typestr}) {elements_list[i].name}{status}\n"
-                if re.fullmatch(r'^\s*\d+\s+\(\*\)\n$', line):
-                    continue
+        使用显式栈代替递归，单次线性遍历完成以下处理，且不修改元素树本身：
+        丢弃没有子元素的组控件；合并连续的文本控件；
+        将只有一个非组子控件的组控件替换为该子控件；
+        名称超过最大字数时截断并追加截断标记。
+        scope 为顶层元素的父标识，用于区分不同窗口中结构相同的元素。
+        collapsed 中的元素折叠显示，不再遍历其子元素；部分折叠的元素只遍历未被隐藏的子元素。
+        层级为该元素之上会输出的祖先元素个数。
+        """
+        collapsed = collapsed or {}
+        # 栈帧：[兄弟元素列表, 下一个位置, 父元素编号, 各控件类型已出现的次数, 层级]
+        stack = [[elements_list, 0, scope, {}, 0]]
+        while stack:
+            frame = stack[-1]
+            siblings, i, parent_id, ordinals, level = frame
+            if i >= len(siblings):
+                stack.pop()
+                continue
+            element = siblings[i]
+            i += 1
 
-                element_info = ElementInfo(
-                    item=elements_list[i].item,
-                    name=elements_list[i].name,
-                    window_title=elements_list[i].window_title,
-                    index=self.g_index
-                )
-
-                if elements_list[i].name.strip():
-                    self.result += line
-                    self.optable.append(element_info)
-                    
-                self.g_index += 1
-
-                if len(elements_list[i].children) > 0:
-                    process_elements(elements_list[i].children, indent + 4)
-                
-        process_elements(self.elements)
-        self.result = self.result.rstrip()
-        return self.result
+            # 因token预算被隐藏的元素
+            if collapsed.get(id(element)) == HIDDEN:
+                frame[1] = i
+                continue
+
+            # 处理嵌套的组控件，折叠的组控件仍然保留
+            if element.type == "GroupControl" and len(element.children) == 0 and not element.collapsed_children:
+                frame[1] = i
+                continue
+
+            name = element.name
+            # 处理嵌套的文本控件，合并所有连续的文本控件，限制最大字数
+            if element.type == "TextControl":
+                parts = [name]
+                length = len(name)
+                while (i < len(siblings) and siblings[i].type == "TextControl"
+                       and collapsed.get(id(siblings[i])) != HIDDEN):
+                    # 超过限制后的文本会被截断，不必再拼接
+                    if length <= self.max_text_length:
+                        parts.append(siblings[i].name)
+                        length += len(siblings[i].name)
+                    i += 1
+                if len(parts) > 1:
+                    name = "".join(parts)
+            frame[1] = i
+
+            # 处理嵌套的组控件
+            if (element.type == "GroupControl" and
+                    len(element.children) == 1 and
+                    element.children[0].type != "GroupControl" and
+                    id(element) not in collapsed):
+                element = element.children[0]
+                name = element.name
+
+            if len(name) > self.max_text_length:
+                name = name[:self.max_text_length] + TRUNCATION_MARK
+
+            collapsed_children = element.collapsed_children or collapsed.get(id(element), 0)
+
+            # 会输出的元素尽量使用RuntimeId识别，其余元素使用结构路径
+            control_type = element.type
+            visible = bool(name.strip() or collapsed_children)
+            if not element.runtime_id and element.item is not None and visible:
+                try:
+                    element.runtime_id = tuple(element.item.GetRuntimeId())
+                except Exception:
+                    pass
+            ordinal = ordinals.get(control_type, 0)
+            ordinals[control_type] = ordinal + 1
+            element_id = self.element_ids.element_id(element.runtime_id, parent_id, control_type, ordinal)
+
+            yield element, name, element_id, collapsed_children, level
+
+            if len(element.children) > collapsed.get(id(element), 0):
+                stack.append([element.children, 0, element_id, {}, level + 1 if visible else level])
+
+    def element_status(self, element, typestr):
+        """生成元素的状态指示"""
+        if "RadioButton" in typestr:
+            return " (已选中)" if element.is_selected else " (未选中)"
+        elif "CheckBox" in typestr:
+            state = element.toggle_state
+            if state == auto.ToggleState.On:
+                return " (已选中)"
+            elif state == auto.ToggleState.Off:
+                return " (未选中)"
+        elif "MenuItem" in typestr and not element.is_enabled:
+            return " (不可用)"
+        return ""
+
+    def iter_records(self, elements_list, scope=None, collapsed=None, compact=False):
+        """为元素编号并产出需要输出的元素，同时填充optable
+
+        产出 (层级, 编号, 控件类型, 名称, 状态, 折叠的子元素个数)。
+        编号由element_ids分配，同一任务中同一元素在各次快照中的编号相同。
+        没有树缓存时，不会输出的元素此后不再被使用，立即释放其控件引用。
+        compact为True时额外省略装饰性控件和与父元素同名的非交互子元素，层级按实际输出的祖先计算；
+        同名的交互控件（例如组合框中的编辑框）仍然输出，否则无法作为操作目标。
+        """
+        release_items = self.tree_cache is None
+        printed = []    # 紧凑格式下已输出的祖先：(层级, 名称)
+        for element, name, element_id, collapsed_children, level in self.iter_elements(elements_list, scope, collapsed):
+            # 折叠的元素即使没有名称也要输出，以便展开
+            visible = bool(name.strip() or collapsed_children)
+            control_type = element.type
+            if visible and compact:
+                while printed and printed[-1][0] >= level:
+                    printed.pop()
+                if not collapsed_children and (control_type in compact_format.DECORATIVE_TYPES or
+                                               (printed and printed[-1][1] == name
+                                                and control_type not in INTERACTIVE_TYPES)):
+                    visible = False
+                else:
+                    printed.append((level, name))
+                    level = len(printed) - 1
+            if not visible:
+                if release_items:
+                    element.cached_type = control_type
+                    element.item = None
+                continue
+
+            status = self.element_status(element, control_type.replace('Control', ''))
+            self.optable.append(element_id, element.item, name, element.window_title,
+                                element.runtime_id, control_type, collapsed_children)
+            # 部分折叠：默认格式中单独说明其余子控件已折叠，紧凑格式的[+N]本身即表示其余N个
+            if collapsed_children and not compact and len(element.children) > collapsed_children:
+                status += f" (其余{collapsed_children}个子控件已折叠)"
+                collapsed_children = 0
+            if compact:
+                self.used_types.add(control_type)
+            yield level, element_id, control_type, name, status, collapsed_children
+
+    def iter_lines(self, elements_list, scope=None, collapsed=None):
+        """逐行产出默认格式的屏幕信息文本"""
+        for _, element_id, control_type, name, status, collapsed_children in self.iter_records(elements_list, scope, collapsed):
+            # 构建元素信息字符串
+            typestr = control_type.replace('Control', '')
+            if collapsed_children:
+                status += f" (已折叠，含{collapsed_children}个子控件)"
+            if not name.strip():
+                name, status = "", status.lstrip()
+            yield f"{element_id} ({typestr}) {name}{status}\n"
+
+    def render_compact(self, elements_list, scope=None, collapsed=None):
+        """生成紧凑格式的窗口内容"""
+        records = [(level, element_id, control_type, name, compact_format.COMPACT_STATUS.get(status, status), count)
+                   for level, element_id, control_type, name, status, count
+                   in self.iter_records(elements_list, scope, collapsed, compact=True)]
+        return compact_format.render(records)
+
+    def window_header(self, window_title, process_name):
+        """窗口的标题信息"""
+        if self.output_format == "compact":
+            return compact_format.window_header(window_title, process_name)
+        return f"窗口标题: {window_title}\n窗口所属进程名称: {process_name}\n"
+
+    def plan_token_budget(self, entries, trees):
+        """在token预算内决定需要折叠的元素，返回 (折叠的元素, 统计信息)"""
+        if not self.token_budget:
+            return None, {}
+        windows = [(trees[target_index], self.window_header(*names), foreground)
+                   for _, names, target_index, foreground in entries
+                   if target_index is not None and isinstance(trees[target_index], list)]
+        collapsed, tokens = self.token_budget.plan(windows, self.get_focused_runtime_id(), self.expanded)
+        return collapsed, {"estimated_tokens": tokens,
+                           "budget_collapsed": sum(1 for hidden in collapsed.values() if hidden > 0)}
+
+    def record_snapshot(self, entries, trees):
+        """把本次快照的元素树保存为JSON，记录失败不影响采集"""
+        def element_record(element):
+            record = {"name": element.name, "type": element.type, "children": []}
+            if element.collapsed_children:
+                record["collapsed"] = element.collapsed_children
+            try:
+                if element.type == "RadioButtonControl":
+                    record["selected"] = bool(element.is_selected)
+                elif element.type == "CheckBoxControl":
+                    record["toggle"] = element.toggle_state
+                elif element.type == "MenuItemControl":
+                    record["enabled"] = bool(element.is_enabled)
+            except Exception:
+                pass
+            return record
+
+        try:
+            windows = []
+            for _, (window_title, process_name), target_index, foreground in entries:
+                elements = trees[target_index] if target_index is not None else []
+                if not isinstance(elements, list):
+                    continue
+                roots = []
+                stack = [(element, roots) for element in reversed(elements)]
+                while stack:
+                    element, siblings = stack.pop()
+                    record = element_record(element)
+                    siblings.append(record)
+                    for child in reversed(element.children):
+                        stack.append((child, record["children"]))
+                windows.append({"title": window_title, "process": process_name,
+                                "foreground": foreground, "elements": roots})
+            os.makedirs(self.record_dir, exist_ok=True)
+            path = os.path.join(self.record_dir, f"snapshot_{time.strftime('%Y%m%d_%H%M%S')}_{time.perf_counter_ns()}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"windows": windows}, f, ensure_ascii=False)
+        except Exception as e:
+            print(f"记录屏幕快照失败: {e}")
 
     def get_screen_info(self):
         """获取所有可见窗口及其元素的信息"""
         self.result = ""
-        self.g_index = 0
-        self.optable = []
+        self.element_ids.begin_snapshot()
+        self.optable = ElementTable()
+        self.used_types = set()
+        self.last_signature = signature = None
+        try:
+            # 在读取元素树之前记录签名，采集期间发生的变化会在下一次判断时被发现
+            signature = self.window_signature()
+        except Exception as e:
+            debug_print(f"计算窗口签名失败: {e}")
         max_retries = 3
         retry_count = 0
+        start_time = time.perf_counter()
 
         while retry_count < max_retries:
             try:
                 windows = auto.WindowControl(searchDepth=1).GetParentControl().GetChildren() # type: ignore
+                foreground_handle = auto.GetForegroundWindow()
+                self.window_meta.begin_snapshot()
+                targets = []
+                entries = []    # (窗口, (标题, 进程名), 在targets中的位置, 是否前台)，最小化的窗口不采集内容
                 for window in windows:
                     try:
+                        # 只用Win32接口预先过滤，不可见的窗口不触及任何子元素
+                        handle = window.NativeWindowHandle
+                        state = self.window_meta.prefilter(handle)
+                        if state not in (WINDOW_VISIBLE, WINDOW_MINIMIZED):
+                            continue
+
                         window_title = window.Name
-                        window_process_name = self.get_window_process_name(window)
+                        pid, window_process_name = self.window_meta.get_process_name(handle, window)
                         
-                        if self.is_window_excluded(window_title, window_process_name):
+                        if self.window_meta.is_excluded(handle, pid, window_title,
+                                                        lambda title: self.is_window_excluded(title, window_process_name)):
                             continue
-                            
-                        self.result += f"窗口标题: {window_title}\n"
-                        self.result += f"窗口所属进程名称: {window_process_name}\n"
-                        
-                        self.result += self.get_window_elements(window)
+
+                        names = (window_title, window_process_name)
+                        if state == WINDOW_MINIMIZED:
+                            entries.append((window, names, None, False))
+                            continue
+
+                        foreground = handle == foreground_handle
+                        policy = self.window_policies.resolve(window_title, window_process_name, foreground)
+                        window_id = tuple(window.GetRuntimeId()) if self.tree_cache else None
+                        targets.append((window, window_id, policy))
+                        entries.append((window, names, len(targets) - 1, foreground))
+                    except Exception as e:
+                        print(f"处理窗口 {window.Name if hasattr(window, 'Name') else '未知'} 时出错: {str(e)}")
+                        continue
+                self.window_meta.end_snapshot()
+                if self.tree_cache:
+                    self.tree_cache.begin_snapshot([window_id for _, window_id, _ in targets])
+
+                # 各窗口可以并行采集，但必须按原有的Z序编号和输出
+                timeouts = 0
+                trees = self.collect_window_trees(targets)
+                if self.record_dir:
+                    self.record_snapshot(entries, trees)
+                collapsed, budget_stats = self.plan_token_budget(entries, trees)
+                for window, names, target_index, _ in entries:
+                    try:
+                        header = self.window_header(*names)
+                        if target_index is None:
+                            self.result += header + "(窗口已最小化)\n\n"
+                            continue
+                        elements = trees[target_index]
+                        if isinstance(elements, Exception):
+                            raise elements
+                        if elements is None:
+                            timeouts += 1
+                            self.result += header + "(窗口内容暂不可用：采集超时)\n\n"
+                            continue
+                        self.result += header
+                        self.result += self.get_window_elements(window, elements=elements, collapsed=collapsed)
+                        if elements[0].truncated:
+                            self.result += "\n(控件数量达到该窗口的上限，其余控件已省略)"
                         self.result += "\n\n"
                     except Exception as e:
                         print(f"处理窗口 {window.Name if hasattr(window, 'Name') else '未知'} 时出错: {str(e)}")
                         continue
                 
+                if self.output_format == "compact" and self.used_types:
+                    self.result = compact_format.legend(self.used_types) + self.result
+                # 没有树缓存时元素树已无用处，执行操作只需要optable
+                if not self.tree_cache:
+                    self.elements = []
+                self.stats = {"elapsed": time.perf_counter() - start_time, "windows": len(windows), "timeouts": timeouts,
+                              "actionable": len(self.optable)}
+                self.stats.update(self.window_meta.stats)
+                self.stats.update(budget_stats)
+                if self.tree_cache:
+                    self.stats.update(self.tree_cache.stats)
+                debug_print(f"屏幕信息收集统计: {self.stats}")
+                self.last_signature = signature
                 return self.result
                 
             except Exception as e:
@@ -217,4 +949,11 @@ class ScreenInfoCollector:
                 retry_count += 1
         
         print(f"重试{max_retries}次后失败")
-        return "获取屏幕信息失败" 
\ No newline at end of file
+        return "获取屏幕信息失败" 
+
+    def close(self):
+        """释放线程池和事件订阅"""
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.tree_cache:
+            self.tree_cache.close()
@@ -0,0 +1,80 @@
+import time
+
+import uiautomation as auto
+
+
+class SettleWaiter:
+    """等待界面在操作后稳定下来，代替固定时长的等待
+
+    满足以下条件即视为稳定：最近quiet秒内目标窗口和前台窗口中没有UI自动化结构变化事件
+    （需要启用树缓存的事件订阅，其他窗口中的动画等不影响判断），
+    且前台窗口和焦点控件组成的指纹在这段时间内没有变化。最多等待timeout秒。
+    """
+
+    def __init__(self, collector, config=None):
+        config = config or {}
+        self.collector = collector
+        self.quiet = config.get("quiet", 0.3)           # 判定稳定所需的静默时间（秒）
+        self.timeout = config.get("timeout", 3.0)       # 等待上限（秒）
+        self.minimum = config.get("minimum", 0.05)      # 至少等待的时间，使操作引发的事件有机会到达
+        self.poll_interval = config.get("poll_interval", 0.05)
+        self.stats = {"waits": 0, "timeouts": 0, "waited_seconds": 0.0}
+
+    def fingerprint(self):
+        """前台窗口句柄和焦点控件的RuntimeId"""
+        try:
+            foreground = auto.GetForegroundWindow()
+        except Exception:
+            foreground = None
+        return foreground, self.collector.get_focused_runtime_id()
+
+    def watched_windows(self, handles):
+        """窗口句柄对应的已缓存窗口，没有树缓存或窗口尚未缓存时不关注其事件"""
+        tree_cache = self.collector.tree_cache
+        if not tree_cache:
+            return ()
+        window_ids = (tree_cache.window_for_handle(handle) for handle in handles if handle)
+        return [window_id for window_id in window_ids if window_id is not None]
+
+    def last_event_time(self, window_ids):
+        tree_cache = self.collector.tree_cache
+        return tree_cache.last_event_time(window_ids) if tree_cache and window_ids else 0.0
+
+    def wait(self, timeout=None, quiet=None, window=None):
+        """等待界面稳定，返回实际等待的秒数
+
+        window 为操作的目标窗口，与前台窗口一起判断是否还有结构变化。
+        """
+        timeout = self.timeout if timeout is None else timeout
+        quiet = self.quiet if quiet is None else quiet
+        start_time = time.monotonic()
+        deadline = start_time + timeout
+        time.sleep(min(self.minimum, timeout))
+
+        try:
+            target = window.NativeWindowHandle if window is not None else None
+        except Exception:
+            target = None
+        fingerprint = self.fingerprint()
+        window_ids = self.watched_windows((target, fingerprint[0]))
+        stable_since = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - max(stable_since, self.last_event_time(window_ids)) >= quiet:
+                break
+            if now >= deadline:
+                self.stats["timeouts"] += 1
+                break
+            time.sleep(min(self.poll_interval, max(deadline - now, 0)))
+            current = self.fingerprint()
+            if current != fingerprint:
+                # 前台窗口可能已经改变
+                if current[0] != fingerprint[0]:
+                    window_ids = self.watched_windows((target, current[0]))
+                fingerprint = current
+                stable_since = time.monotonic()
+
+        waited = time.monotonic() - start_time
+        self.stats["waits"] += 1
+        self.stats["waited_seconds"] += waited
+        return waited
@@ -0,0 +1,104 @@
+import re
+
+# 默认格式和紧凑格式的窗口标题行
+WINDOW_HEADER = ("窗口标题: ", "# ")
+# 控件行以编号开头（紧凑格式下前面可能有缩进）
+ELEMENT_LINE = re.compile(r"\s*(\d+)\s")
+
+DIFF_HEADER = "屏幕变化（相对上一步的屏幕信息，+ 新增，- 移除，~ 内容变化；未列出的控件保持不变）：\n"
+
+
+def parse_snapshot(screen_info):
+    """把屏幕信息拆分为窗口，返回 {窗口标题行: {行键: 行}}，均保持原有顺序
+
+    控件行以控件编号为键，其余行（进程名、提示信息等）以行文本本身为键。
+    第一个窗口之前的内容归入标题为空字符串的分组。
+    """
+    windows = {}
+    lines = windows.setdefault("", {})
+    for line in screen_info.splitlines():
+        if line.startswith(WINDOW_HEADER):
+            lines = windows.setdefault(line, {})
+            continue
+        if not line.strip():
+            continue
+        match = ELEMENT_LINE.match(line)
+        lines[int(match.group(1)) if match else line] = line
+    return windows
+
+
+def diff_snapshots(old, new):
+    """比较两个parse_snapshot的结果，返回差异文本，没有变化时返回空字符串"""
+    parts = []
+    for header, lines in new.items():
+        old_lines = old.get(header)
+        if old_lines is None:
+            if lines:
+                parts.append(f"+ 新窗口\n{header}\n" + "".join(f"{line}\n" for line in lines.values()))
+            continue
+        changes = []
+        for key, line in old_lines.items():
+            if key not in lines:
+                changes.append(f"- {line.strip()}\n")
+        for key, line in lines.items():
+            old_line = old_lines.get(key)
+            if old_line is None:
+                changes.append(f"+ {line.strip()}\n")
+            elif old_line != line:
+                changes.append(f"~ {line.strip()}\n")
+        if changes:
+            parts.append((f"{header}\n" if header else "") + "".join(changes))
+    for header in old:
+        if header and header not in new:
+            parts.append(f"- 窗口已关闭\n{header}\n")
+    return "\n".join(parts)
+
+
+class SnapshotDiffer:
+    """在相邻两步之间只发送屏幕信息的变化
+
+    以模型最近一次确实收到的屏幕信息为基准计算差异。以下情况发送完整屏幕信息：
+    没有基准；距上一次完整发送已达full_every步；差异文本超过完整文本的max_ratio；
+    调用者通过reset()声明基准已失效（例如开始新的任务）。
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.enabled = config.get("enabled", True)
+        self.full_every = config.get("full_every", 5)
+        self.max_ratio = config.get("max_ratio", 0.5)
+        self.base = None            # 模型已收到的屏幕信息（解析后）
+        self.steps_since_full = 0
+        self.pending = None
+        # 最近一次render的差异文本与完整文本的长度之比；没有基准时无从比较，为0
+        self.change_ratio = 0.0
+        self.stats = {"full": 0, "diff": 0, "full_chars": 0, "sent_chars": 0}
+
+    def reset(self):
+        self.base = None
+        self.pending = None
+
+    def render(self, screen_info):
+        """返回 (要发送的屏幕信息, 是否为完整屏幕信息)"""
+        snapshot = parse_snapshot(screen_info)
+        text, full = screen_info, True
+        self.change_ratio = 0.0
+        if self.base is not None:
+            diff = diff_snapshots(self.base, snapshot)
+            self.change_ratio = min(1.0, len(diff) / max(len(screen_info), 1))
+            if self.enabled and self.steps_since_full < self.full_every and len(diff) <= len(screen_info) * self.max_ratio:
+                text, full = DIFF_HEADER + (diff or "屏幕没有变化\n"), False
+        self.pending = (snapshot, full, len(screen_info), len(text))
+        return text, full
+
+    def commit(self):
+        """模型已收到最近一次render的结果，将其作为下一步的基准"""
+        if self.pending is None:
+            return
+        snapshot, full, full_chars, sent_chars = self.pending
+        self.pending = None
+        self.base = snapshot
+        self.steps_since_full = 0 if full else self.steps_since_full + 1
+        self.stats["full" if full else "diff"] += 1
+        self.stats["full_chars"] += full_chars
+        self.stats["sent_chars"] += sent_chars
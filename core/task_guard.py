@@ -0,0 +1,89 @@
+from .debug import debug_print
+
+
+class TaskGuard:
+    """控制循环的无进展检测
+
+    每一步结束后检查：步数是否超出预算、屏幕信息是否连续多步相同、
+    是否连续多步重复完全相同的操作、是否连续多步失败（没有有效响应或操作全部失败）。
+    达到warn_after时给模型发送提示（同时使下一步升级到强模型），达到stop_after时停止任务。
+    没有产生任何效果的模型调用计为浪费的调用。
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.max_steps = config.get("max_steps", 50)
+        self.warn_after = config.get("warn_after", 2)
+        self.stop_after = config.get("stop_after", 4)
+        self.max_failures = config.get("max_failures", 3)
+        self.begin_task()
+
+    def begin_task(self):
+        self.steps = 0
+        self.last_screen = None
+        self.same_screen = 0        # 屏幕信息连续相同的步数
+        self.last_actions = None
+        self.same_actions = 0       # 连续重复相同操作的步数
+        self.failures = 0           # 连续失败的步数
+        self.previous_acted = False
+        self.stats = {"llm_calls": 0, "wasted_calls": 0, "no_response": 0, "no_action": 0,
+                      "failed_actions": 0, "no_effect": 0}
+
+    def check_screen(self, digest):
+        """每一步采集屏幕信息后调用，返回 (提示信息, 停止原因)，均可能为None
+
+        digest 为本步屏幕信息的摘要（change_gate.screen_digest），与ChangeGate共用同一次计算。
+        """
+        if digest == self.last_screen:
+            self.same_screen += 1
+            # 上一步执行了操作但屏幕没有任何变化，上一次调用没有效果
+            if self.previous_acted:
+                self.stats["no_effect"] += 1
+                self.stats["wasted_calls"] += 1
+        else:
+            self.same_screen = 0
+        self.last_screen = digest
+
+        if self.steps >= self.max_steps:
+            return None, f"已达到步数上限{self.max_steps}"
+        if self.same_screen >= self.stop_after:
+            return None, f"屏幕信息连续{self.same_screen + 1}步没有变化"
+        if self.same_actions >= self.stop_after:
+            return None, f"连续{self.same_actions + 1}步重复相同的操作"
+        if self.failures >= self.max_failures:
+            return None, f"连续{self.failures}步失败"
+        if self.same_screen >= self.warn_after:
+            return f"屏幕信息已连续{self.same_screen + 1}步没有变化，之前的操作没有效果，请换一种方法", None
+        if self.same_actions >= self.warn_after:
+            return f"你已连续{self.same_actions + 1}步给出相同的操作，请检查任务是否已完成或换一种方法", None
+        return None, None
+
+    def record_step(self, responded, actions, failed, done=False):
+        """模型调用和操作执行结束后调用
+
+        responded 表示是否得到有效响应，actions 为执行的操作文本列表，failed 为其中失败的个数，
+        done 表示模型确认任务已完成。
+        """
+        self.steps += 1
+        self.stats["llm_calls"] += 1
+        succeeded = len(actions) - failed
+        self.previous_acted = succeeded > 0
+        if not responded:
+            self.stats["no_response"] += 1
+        elif not actions and not done:
+            self.stats["no_action"] += 1
+        elif actions and not succeeded:
+            self.stats["failed_actions"] += 1
+        if not responded or not (succeeded or done):
+            self.failures += 1
+            self.stats["wasted_calls"] += 1
+        else:
+            self.failures = 0
+
+        if responded:
+            if actions and actions == self.last_actions:
+                self.same_actions += 1
+            else:
+                self.same_actions = 0
+            self.last_actions = actions
+        debug_print(f"任务进展统计: 步数{self.steps}，{self.stats}")
@@ -0,0 +1,183 @@
+import re
+
+# 中日韩字符，大多数分词器中约每个字对应一个token
+CJK_PATTERN = re.compile(r"[　-〿㐀-䶿一-鿿豈-﫿＀-￯]")
+CJK_RUN = re.compile(r"[一-鿿]+")
+WORD = re.compile(r"[A-Za-z0-9_]{2,}")
+
+# 可交互的控件类型
+INTERACTIVE_TYPES = frozenset({
+    "ButtonControl", "EditControl", "CheckBoxControl", "RadioButtonControl", "ComboBoxControl",
+    "ListItemControl", "MenuItemControl", "TabItemControl", "HyperlinkControl", "TreeItemControl",
+    "SplitButtonControl", "SliderControl", "SpinnerControl", "DataItemControl", "DocumentControl",
+})
+
+# 排序权重：子树的得分取其中所有元素得分的最大值，得分低的子树先被折叠
+SCORE_EXPANDED = 100000     # 用户通过expand展开的元素
+SCORE_FOREGROUND = 1000     # 前台窗口中的元素
+SCORE_FOCUSED = 500         # 拥有键盘焦点的元素
+SCORE_RELEVANT = 100        # 名称中每命中一个任务关键词（最多计3个）
+SCORE_INTERACTIVE = 10      # 可交互的控件
+
+# 一行控件信息中编号、类型等固定部分的字符数，以及折叠提示的token数
+LINE_OVERHEAD_CHARS = 14
+COLLAPSED_OVERHEAD = 8
+
+# plan返回值中标记被隐藏的元素（其父元素只部分折叠）
+HIDDEN = -1
+
+
+def token_weight(text):
+    """近似估计文本的token数（不取整）：中日韩字符每字约1个token，其余字符约每4个字符1个token"""
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk) / 4
+
+
+def estimate_tokens(text):
+    return int(token_weight(text) + 0.999)
+
+
+def extract_keywords(text):
+    """从任务和大纲中提取关键词：英文单词以及中文的二元组"""
+    keywords = {word.lower() for word in WORD.findall(text)}
+    for run in CJK_RUN.findall(text):
+        if len(run) == 1:
+            continue
+        keywords.update(run[i:i + 2] for i in range(len(run) - 1))
+    return keywords
+
+
+class TokenBudget:
+    """在屏幕信息超出token预算时，按重要性折叠窗口或子树
+
+    排序依据：是否在前台窗口、是否拥有键盘焦点、是否为可交互控件、
+    名称与任务和大纲的相关程度；用户展开过的元素最后才会被折叠。
+    被折叠的元素与超出快照深度的元素显示方式相同，可以通过expand展开。
+    较大的子树只隐藏得分最低的一部分子元素，使结果接近预算而不是远低于预算。
+    """
+
+    def __init__(self, budget, max_text_length=500):
+        self.budget = budget
+        self.max_text_length = max_text_length
+        self.keywords_re = None
+
+    def set_context(self, text):
+        """设置用于计算相关性的任务和大纲文本"""
+        keywords = sorted(extract_keywords(text or ""), key=len, reverse=True)
+        self.keywords_re = re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE) if keywords else None
+
+    def line_cost(self, element):
+        name = element.name[:self.max_text_length]
+        if not name.strip() and not element.collapsed_children:
+            return 0
+        return token_weight(name) + LINE_OVERHEAD_CHARS / 4
+
+    def element_score(self, element, focused_id, expanded):
+        score = SCORE_INTERACTIVE if element.type in INTERACTIVE_TYPES else 0
+        if self.keywords_re and element.name:
+            hits = len(set(self.keywords_re.findall(element.name[:self.max_text_length].lower())))
+            score += SCORE_RELEVANT * min(hits, 3)
+        if element.runtime_id:
+            if element.runtime_id == focused_id:
+                score += SCORE_FOCUSED
+            if element.runtime_id in expanded:
+                score += SCORE_EXPANDED
+        return score
+
+    def plan(self, windows, focused_id=None, expanded=()):
+        """决定需要折叠的元素
+
+        windows 为 (元素列表, 窗口标题信息, 是否为前台窗口) 列表。
+        返回 ({id(元素): 折叠的子元素个数}, 预计token数)，未超出预算时返回空字典。
+        部分折叠的元素只隐藏得分最低的一部分子元素，被隐藏的子元素在字典中标记为HIDDEN。
+        """
+        # 先序展开所有元素，记录父元素位置、深度和子元素位置
+        nodes, parents, depths, costs, scores, children = [], [], [], [], [], []
+        total = 0
+        for elements, header, foreground in windows:
+            total += estimate_tokens(header)
+            bonus = SCORE_FOREGROUND if foreground else 0
+            stack = [(element, -1) for element in reversed(elements)]
+            while stack:
+                element, parent = stack.pop()
+                position = len(nodes)
+                nodes.append(element)
+                parents.append(parent)
+                depths.append(depths[parent] + 1 if parent >= 0 else 0)
+                children.append([])
+                if parent >= 0:
+                    children[parent].append(position)
+                cost = self.line_cost(element)
+                costs.append(cost)
+                scores.append(self.element_score(element, focused_id, expanded) + bonus)
+                total += cost
+                for child in reversed(element.children):
+                    stack.append((child, position))
+        if not self.budget or total <= self.budget:
+            return {}, int(total)
+
+        # 逆序累加得到每个子树的token数和得分
+        subtree_costs = list(costs)
+        subtree_scores = list(scores)
+        for position in range(len(nodes) - 1, 0, -1):
+            parent = parents[position]
+            if parent >= 0:
+                subtree_costs[parent] += subtree_costs[position]
+                if subtree_scores[position] > subtree_scores[parent]:
+                    subtree_scores[parent] = subtree_scores[position]
+
+        # 得分低的先折叠；祖先的得分不低于其中任何后代，得分相同时先处理较深、较小的子树，
+        # 因此只有折叠所有后代仍不能满足预算时才会折叠祖先
+        candidates = [position for position, element in enumerate(nodes) if element.children]
+        candidates.sort(key=lambda position: (subtree_scores[position], -depths[position], subtree_costs[position]))
+        collapsed = {}
+        removed = bytearray(len(nodes))     # 被隐藏或子元素已全部折叠的元素
+
+        def reduce(position, saving):
+            nonlocal total
+            total -= saving
+            while position >= 0:
+                subtree_costs[position] -= saving
+                position = parents[position]
+
+        def fold(position):
+            element = nodes[position]
+            hidden = collapsed.get(id(element), 0)
+            # 折叠提示本身也占用token，没有名称的元素折叠后也要输出
+            marker = COLLAPSED_OVERHEAD + (0 if costs[position] else LINE_OVERHEAD_CHARS / 4)
+            if not hidden:
+                if subtree_costs[position] - costs[position] <= marker:
+                    return
+                reduce(position, -marker)
+            # 逐个隐藏得分最低的子元素，接近预算即停止；得分相同时先隐藏靠后的
+            remaining = [child for child in children[position] if not removed[child]]
+            remaining.sort(key=lambda child: (subtree_scores[child], -child))
+            for child in remaining:
+                if total <= self.budget:
+                    break
+                removed[child] = 1
+                collapsed[id(nodes[child])] = HIDDEN
+                hidden += 1
+                reduce(position, subtree_costs[child])
+            collapsed[id(element)] = hidden
+            if hidden == len(children[position]):
+                # 全部折叠时不再需要逐个标记子元素
+                removed[position] = 1
+                for child in children[position]:
+                    collapsed.pop(id(nodes[child]), None)
+
+        def is_removed(position):
+            while position >= 0:
+                if removed[position]:
+                    return True
+                position = parents[position]
+            return False
+
+        for position in candidates:
+            if total <= self.budget:
+                break
+            # 自身或祖先已被隐藏的元素不再处理
+            if is_removed(position):
+                continue
+            fold(position)
+        return collapsed, int(total)
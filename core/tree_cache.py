@@ -0,0 +1,344 @@
+import threading
+import time
+from .debug import debug_print
+
+# UI自动化属性ID
+UIA_RuntimeIdPropertyId = 30000
+UIA_ControlTypePropertyId = 30003
+UIA_NamePropertyId = 30005
+UIA_IsEnabledPropertyId = 30010
+UIA_SelectionItemIsSelectedPropertyId = 30079
+UIA_ToggleToggleStatePropertyId = 30086
+
+# 结构变化类型：子元素被移除
+StructureChangeType_ChildRemoved = 1
+
+
+class TreeEventProvider:
+    """UI树变化事件源接口
+
+    on_change(runtime_id, structural)：
+        runtime_id 为发生变化的元素的RuntimeId元组；
+        structural 为True表示该元素的子树结构发生变化，False表示仅属性发生变化。
+    """
+
+    def start(self, on_change):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class FakeEventProvider(TreeEventProvider):
+    """内存中的事件源，用于测试，通过emit手动触发事件"""
+
+    def __init__(self):
+        self.on_change = None
+
+    def start(self, on_change):
+        self.on_change = on_change
+
+    def stop(self):
+        self.on_change = None
+
+    def emit(self, runtime_id, structural=True):
+        if self.on_change:
+            self.on_change(tuple(runtime_id), structural)
+
+
+class UIAEventProvider(TreeEventProvider):
+    """订阅UI自动化结构变化事件和属性变化事件的事件源
+
+    事件处理器在单独的MTA线程中注册，避免与界面线程互相阻塞。
+    """
+
+    def __init__(self):
+        self.on_change = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def start(self, on_change):
+        self.on_change = on_change
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=2)
+
+    def _notify(self, runtime_id, structural):
+        if self.on_change and runtime_id:
+            self.on_change(tuple(runtime_id), structural)
+
+    def _run(self):
+        # 只有真正订阅事件时才需要UI自动化，缓存本身和FakeEventProvider不依赖它
+        import comtypes
+        import comtypes.client
+        import uiautomation as auto
+        comtypes.CoInitializeEx(comtypes.COINIT_MULTITHREADED)
+        try:
+            UIA = auto._AutomationClient.instance().UIAutomationCore
+            uia = comtypes.client.CreateObject(UIA.CUIAutomation, interface=UIA.IUIAutomation)
+            root = uia.GetRootElement()
+            provider = self
+
+            class StructureChangedHandler(comtypes.COMObject):
+                _com_interfaces_ = [UIA.IUIAutomationStructureChangedEventHandler]
+
+                def HandleStructureChangedEvent(self, sender, changeType, runtimeId):
+                    try:
+                        # 子元素被移除时sender可能已失效，此时runtimeId为被移除元素自身
+                        if changeType == StructureChangeType_ChildRemoved and runtimeId:
+                            provider._notify(runtimeId, True)
+                        provider._notify(sender.GetRuntimeId(), True)
+                    except Exception:
+                        pass
+                    return 0
+
+            class PropertyChangedHandler(comtypes.COMObject):
+                _com_interfaces_ = [UIA.IUIAutomationPropertyChangedEventHandler]
+
+                def HandlePropertyChangedEvent(self, sender, propertyId, newValue):
+                    try:
+                        provider._notify(sender.GetRuntimeId(), False)
+                    except Exception:
+                        pass
+                    return 0
+
+            structure_handler = StructureChangedHandler()
+            property_handler = PropertyChangedHandler()
+            properties = [UIA_NamePropertyId, UIA_IsEnabledPropertyId,
+                          UIA_SelectionItemIsSelectedPropertyId, UIA_ToggleToggleStatePropertyId]
+            uia.AddStructureChangedEventHandler(root, auto.TreeScope.Subtree, None, structure_handler)
+            uia.AddPropertyChangedEventHandlerNativeArray(
+                root, auto.TreeScope.Subtree, None, property_handler,
+                (comtypes.c_int * len(properties))(*properties), len(properties))
+            debug_print("UI自动化事件订阅已启动")
+
+            self._stop_event.wait()
+            uia.RemoveAllEventHandlers()
+        except Exception as e:
+            print(f"订阅UI自动化事件失败: {e}")
+        finally:
+            comtypes.CoUninitialize()
+
+
+class UITreeCache:
+    """持久化的UI树缓存
+
+    按窗口缓存collect_elements的结果，收到事件后只把对应元素标记为失效，
+    下次获取时仅重新获取失效的子树（结构变化）或刷新失效元素本身的属性（属性变化）。
+    """
+
+    def __init__(self, provider=None, max_age=30):
+        self.provider = provider
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._windows = {}          # 窗口RuntimeId -> (根ElementInfo, 获取时间, 采集策略)
+        self._dirty = set()         # 子树需要重新获取的元素
+        self._stale = set()         # 仅属性需要刷新的元素
+        self._all_dirty = False
+        self._pending_dirty = set()
+        self._pending_stale = set()
+        self._owners = {}           # 已缓存元素的RuntimeId -> 所属窗口的RuntimeId
+        self._aliases = {}          # 被略去的元素的RuntimeId -> 接管其子元素的祖先的RuntimeId
+        self._members = {}          # 窗口RuntimeId -> 其中所有元素的RuntimeId
+        self._window_events = {}    # 窗口RuntimeId -> 该窗口最近一次结构变化事件的时间
+        self._handles = {}          # 窗口句柄 -> 窗口RuntimeId
+        self._refreshed = False     # 上次快照之后是否已在推测性刷新中应用过事件
+        self.stats = self._new_stats()
+        if self.provider:
+            self.provider.start(self._on_change)
+
+    @staticmethod
+    def _new_stats():
+        return {"window_hits": 0, "window_fetches": 0, "subtree_fetches": 0, "property_refreshes": 0}
+
+    def _count(self, key):
+        # 多个采集线程可能同时更新统计
+        with self._lock:
+            self.stats[key] += 1
+
+    def _on_change(self, runtime_id, structural):
+        with self._lock:
+            # 被略去的元素不在缓存的树中，其任何变化都使接管其子元素的祖先失效
+            ancestor = self._aliases.get(runtime_id)
+            if ancestor is not None:
+                runtime_id, structural = ancestor, True
+            if structural:
+                self._dirty.add(runtime_id)
+                window_id = self._owners.get(runtime_id)
+                if window_id is not None:
+                    self._window_events[window_id] = time.monotonic()
+            else:
+                self._stale.add(runtime_id)
+
+    def invalidate(self, runtime_id=None):
+        """手动使某个元素的子树失效，不传参数则使整个缓存失效"""
+        with self._lock:
+            if runtime_id is None:
+                self._all_dirty = True
+            else:
+                self._dirty.add(tuple(runtime_id))
+
+    def has_changes(self):
+        """判断自上次快照以来是否有事件落在已缓存的窗口中，用于在采集之前廉价地判断屏幕是否变化
+
+        有窗口的缓存超过max_age时也视为有变化：不发送事件的应用和未订阅的变化（如文档文本）
+        只能靠按时重新获取发现。
+        """
+        with self._lock:
+            if self._all_dirty or self._refreshed:
+                return True
+            now = time.monotonic()
+            if any(now - fetched > self.max_age for _, fetched, _ in self._windows.values()):
+                return True
+            return any(runtime_id in self._owners for runtime_id in self._dirty | self._stale)
+
+    def last_event_time(self, window_ids):
+        """指定窗口中最近一次结构变化事件的时间，没有事件时返回0"""
+        with self._lock:
+            return max((self._window_events.get(window_id, 0.0) for window_id in window_ids), default=0.0)
+
+    def window_for_handle(self, handle):
+        """窗口句柄对应的已缓存窗口的RuntimeId，未缓存时返回None"""
+        with self._lock:
+            return self._handles.get(handle)
+
+    def _index_window(self, window_id, window, root):
+        """记录窗口中各元素所属的窗口，使事件可以对应到窗口"""
+        members = []
+        aliases = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.runtime_id:
+                members.append(node.runtime_id)
+                aliases.extend((spliced_id, node.runtime_id) for spliced_id in node.spliced_ids)
+            stack.extend(node.children)
+        try:
+            handle = window.NativeWindowHandle
+        except Exception:
+            handle = 0
+        with self._lock:
+            self._forget_window(window_id)
+            self._members[window_id] = members
+            self._owners[window_id] = window_id
+            for runtime_id in members:
+                self._owners[runtime_id] = window_id
+            for spliced_id, ancestor in aliases:
+                self._aliases[spliced_id] = ancestor
+                self._owners[spliced_id] = window_id
+                members.append(spliced_id)
+            if handle:
+                self._handles[handle] = window_id
+
+    def _forget_window(self, window_id):
+        """移除窗口的索引，调用时需持有锁"""
+        for runtime_id in self._members.pop(window_id, ()):
+            if self._owners.get(runtime_id) == window_id:
+                del self._owners[runtime_id]
+                self._aliases.pop(runtime_id, None)
+        self._owners.pop(window_id, None)
+        self._window_events.pop(window_id, None)
+        for handle in [handle for handle, owner in self._handles.items() if owner == window_id]:
+            del self._handles[handle]
+
+    def begin_refresh(self):
+        """开始一次只更新缓存的推测性刷新：取出落在已缓存窗口中的失效标记
+
+        返回收到事件的窗口 [(窗口句柄, 窗口RuntimeId, 采集策略)]，其余标记留给下一次快照。
+        """
+        with self._lock:
+            if self._all_dirty:
+                return []
+            windows = {window_id: handle for handle, window_id in self._handles.items() if window_id in self._windows}
+            changed = {self._owners.get(runtime_id) for runtime_id in self._dirty | self._stale} & windows.keys()
+            self._pending_dirty = {r for r in self._dirty if self._owners.get(r) in changed}
+            self._pending_stale = {r for r in self._stale if self._owners.get(r) in changed}
+            self._dirty -= self._pending_dirty
+            self._stale -= self._pending_stale
+            if changed:
+                self._refreshed = True
+            return [(windows[window_id], window_id, self._windows[window_id][2]) for window_id in changed]
+
+    def begin_snapshot(self, window_ids):
+        """开始一次屏幕快照：取出目前累积的失效标记，并丢弃已关闭窗口的缓存"""
+        with self._lock:
+            self._refreshed = False
+            self._pending_dirty, self._dirty = self._dirty, set()
+            self._pending_stale, self._stale = self._stale, set()
+            if self._all_dirty:
+                for window_id in list(self._windows):
+                    self._forget_window(window_id)
+                self._windows.clear()
+                self._all_dirty = False
+            window_ids = set(window_ids)
+            for window_id in list(self._windows):
+                if window_id not in window_ids:
+                    self._forget_window(window_id)
+                    del self._windows[window_id]
+        self.stats = self._new_stats()
+
+    def get(self, window_id, window, collect, refresh, tag=None):
+        """获取窗口的元素树
+
+        collect(control, depth) 重新获取某个控件的子树并返回ElementInfo，depth为控件在窗口中的深度；
+        refresh(element_info) 重新读取某个元素自身的属性；
+        tag 为采集该窗口时使用的策略，与缓存时不同则重新获取整个窗口。
+        """
+        with self._lock:
+            cached = self._windows.get(window_id)
+
+        now = time.monotonic()
+        if (cached is None or window_id in self._pending_dirty
+                or now - cached[1] > self.max_age or cached[2] != tag):
+            root = collect(window, 0)
+            self._count("window_fetches")
+            with self._lock:
+                self._windows[window_id] = (root, now, tag)
+            self._index_window(window_id, window, root)
+            return root
+
+        root = cached[0]
+        self._count("window_hits")
+        if window_id in self._pending_stale:
+            refresh(root)
+            self._count("property_refreshes")
+        if self._pending_dirty or self._pending_stale:
+            try:
+                if self._update_children(root, collect, refresh):
+                    self._index_window(window_id, window, root)
+            except Exception as e:
+                # 失效的子树可能已被销毁，放弃该窗口的缓存，重新获取整个窗口
+                debug_print(f"更新缓存子树失败: {e}")
+                root = collect(window, 0)
+                self._count("window_fetches")
+                with self._lock:
+                    self._windows[window_id] = (root, now, tag)
+                self._index_window(window_id, window, root)
+        return root
+
+    def _update_children(self, element_info, collect, refresh):
+        """在缓存的树中替换失效的子树，返回是否有子树被替换"""
+        replaced = False
+        stack = [element_info]
+        while stack:
+            node = stack.pop()
+            for i, child in enumerate(node.children):
+                if child.runtime_id in self._pending_dirty:
+                    node.children[i] = collect(child.item, child.depth)
+                    self._count("subtree_fetches")
+                    replaced = True
+                    continue
+                if child.runtime_id in self._pending_stale:
+                    refresh(child)
+                    self._count("property_refreshes")
+                stack.append(child)
+        return replaced
+
+    def close(self):
+        if self.provider:
+            self.provider.stop()
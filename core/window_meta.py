@@ -0,0 +1,123 @@
+import ctypes
+from ctypes import wintypes
+import time
+import psutil
+
+DWMWA_CLOAKED = 14
+
+# 预过滤结果
+WINDOW_VISIBLE = "visible"
+WINDOW_MINIMIZED = "minimized"
+WINDOW_HIDDEN = "hidden"
+WINDOW_CLOAKED = "cloaked"
+WINDOW_ZERO_AREA = "zero_area"
+
+
+def get_window_pid(handle):
+    """通过Win32接口获取窗口所属进程ID，不经过UI自动化"""
+    pid = wintypes.DWORD()
+    ctypes.windll.user32.GetWindowThreadProcessId(wintypes.HWND(handle), ctypes.byref(pid))
+    return pid.value
+
+
+def get_window_state(handle):
+    """只使用Win32和DWM接口判断窗口是否值得采集，不触及任何子元素"""
+    user32 = ctypes.windll.user32
+    hwnd = wintypes.HWND(handle)
+    if not user32.IsWindowVisible(hwnd):
+        return WINDOW_HIDDEN
+    if user32.IsIconic(hwnd):
+        return WINDOW_MINIMIZED
+
+    # 被DWM隐藏的窗口（其他虚拟桌面上的窗口、挂起的UWP应用等）
+    cloaked = wintypes.DWORD()
+    if ctypes.windll.dwmapi.DwmGetWindowAttribute(hwnd, DWMWA_CLOAKED, ctypes.byref(cloaked),
+                                                   ctypes.sizeof(cloaked)) == 0 and cloaked.value:
+        return WINDOW_CLOAKED
+
+    rect = wintypes.RECT()
+    if user32.GetWindowRect(hwnd, ctypes.byref(rect)):
+        if rect.right <= rect.left or rect.bottom <= rect.top:
+            return WINDOW_ZERO_AREA
+    return WINDOW_VISIBLE
+
+
+class WindowMetaCache:
+    """按窗口句柄和进程ID缓存窗口元数据
+
+    进程名按进程ID缓存，窗口的排除结果按 (窗口句柄, 进程ID, 标题) 缓存；
+    每次快照结束时清除已不存在的窗口和已退出的进程。
+    """
+
+    def __init__(self):
+        self.process_names = {}     # 进程ID -> 进程名
+        self.windows = {}           # 窗口句柄 -> {"pid", "title", "excluded"}
+        self.seen_handles = set()
+        self.lookup_cost = 0.0      # 单次查询进程名的平均耗时，用于估算节省的时间
+        self.lookups = 0
+        self.stats = self._new_stats()
+
+    @staticmethod
+    def _new_stats():
+        return {"process_name_hits": 0, "process_name_lookups": 0, "exclusion_hits": 0,
+                "skipped_hidden": 0, "skipped_cloaked": 0, "skipped_zero_area": 0, "minimized": 0}
+
+    def begin_snapshot(self):
+        self.seen_handles = set()
+        self.stats = self._new_stats()
+
+    def prefilter(self, handle):
+        """返回窗口的预过滤结果，句柄为0的窗口无法判断，视为可见"""
+        if not handle:
+            return WINDOW_VISIBLE
+        self.seen_handles.add(handle)
+        state = get_window_state(handle)
+        if state == WINDOW_MINIMIZED:
+            self.stats["minimized"] += 1
+        elif state != WINDOW_VISIBLE:
+            self.stats[f"skipped_{state}"] += 1
+        return state
+
+    def window_state(self, handle):
+        """与prefilter相同的判断，但不计入统计"""
+        return get_window_state(handle) if handle else WINDOW_VISIBLE
+
+    def get_process_name(self, handle, window):
+        """获取窗口的进程名称，同一进程只查询一次"""
+        pid = get_window_pid(handle) if handle else window.ProcessId
+        name = self.process_names.get(pid)
+        if name is not None:
+            self.stats["process_name_hits"] += 1
+            return pid, name
+
+        start = time.perf_counter()
+        try:
+            name = psutil.Process(pid).name()
+            self.process_names[pid] = name
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess) as e:
+            print(f"获取进程名称时出错: {e}")
+            name = "未知"
+        self.lookups += 1
+        self.lookup_cost += (time.perf_counter() - start - self.lookup_cost) / self.lookups
+        self.stats["process_name_lookups"] += 1
+        return pid, name
+
+    def is_excluded(self, handle, pid, window_title, check):
+        """返回窗口是否被排除，标题或进程变化时才重新调用check(标题)匹配"""
+        meta = self.windows.get(handle)
+        if meta and meta["pid"] == pid and meta["title"] == window_title:
+            self.stats["exclusion_hits"] += 1
+            return meta["excluded"]
+        excluded = check(window_title)
+        if handle:
+            self.windows[handle] = {"pid": pid, "title": window_title, "excluded": excluded}
+        return excluded
+
+    def end_snapshot(self):
+        """清除已关闭的窗口和已退出的进程"""
+        for handle in [h for h in self.windows if h not in self.seen_handles]:
+            del self.windows[handle]
+        live_pids = {meta["pid"] for meta in self.windows.values()}
+        for pid in [p for p in self.process_names if p not in live_pids or not psutil.pid_exists(p)]:
+            del self.process_names[pid]
+        self.stats["saved_seconds"] = round(self.stats["process_name_hits"] * self.lookup_cost, 4)
@@ -0,0 +1,95 @@
+from dataclasses import dataclass
+from typing import Optional, FrozenSet
+import re
+
+
+@dataclass(frozen=True)
+class WindowPolicy:
+    """单个窗口的采集策略
+
+    max_depth: 快照深度，0表示不限制
+    max_elements: 最多访问的控件数量（包括按control_types不输出的控件），0表示不限制
+    control_types: 允许输出的控件类型，None表示全部允许；其他类型的控件本身不输出，但仍会遍历其子控件
+    title_only: 只采集窗口本身，窗口内容折叠显示
+    """
+    max_depth: int = 0
+    max_elements: int = 0
+    control_types: Optional[FrozenSet[str]] = None
+    title_only: bool = False
+
+    @classmethod
+    def from_config(cls, config):
+        control_types = config.get("control_types")
+        if control_types is not None:
+            # 允许省略类型名末尾的Control
+            control_types = frozenset(t if t.endswith("Control") else t + "Control" for t in control_types)
+        return cls(
+            max_depth=config.get("max_depth", 0),
+            max_elements=config.get("max_elements", 0),
+            control_types=control_types,
+            title_only=config.get("title_only", False),
+        )
+
+    def depth_limit(self):
+        """返回深度上限，None表示不限制"""
+        if self.title_only:
+            return 0
+        return self.max_depth or None
+
+    def is_bounded(self):
+        """是否限制了深度或控件数量"""
+        return self.depth_limit() is not None or bool(self.max_elements)
+
+    def allows(self, control_type):
+        return self.control_types is None or control_type in self.control_types
+
+
+def compile_pattern(pattern):
+    """编译窗口匹配用的正则，空模式或无效模式返回None"""
+    if not pattern:
+        return None
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        print(f"无效的窗口匹配模式 {pattern}: {e}")
+        return None
+
+
+class WindowMatcher:
+    """预编译的窗口标题/进程名匹配规则，任一正则匹配即视为匹配"""
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.title_re = compile_pattern(rule.get("title_pattern", ""))
+        self.process_re = compile_pattern(rule.get("process_pattern", ""))
+
+    def matches(self, window_title, window_process_name):
+        if self.title_re and self.title_re.search(window_title):
+            return True
+        if self.process_re and self.process_re.search(window_process_name):
+            return True
+        return False
+
+
+class WindowPolicies:
+    """根据exwindows.json中的配置为每个窗口确定采集策略
+
+    先按窗口是否为前台窗口选择foreground_policy或background_policy作为基础，
+    再用window_policies中第一条匹配的规则覆盖。
+    """
+
+    def __init__(self, data=None, default_max_depth=0):
+        data = data or {}
+        self.default = {"max_depth": default_max_depth}
+        self.foreground = data.get("foreground_policy", {})
+        self.background = data.get("background_policy", {})
+        self.rules = [WindowMatcher(rule) for rule in data.get("window_policies", [])]
+
+    def resolve(self, window_title, window_process_name, foreground=False):
+        config = dict(self.default)
+        config.update(self.foreground if foreground else self.background)
+        for matcher in self.rules:
+            if matcher.matches(window_title, window_process_name):
+                config.update({k: v for k, v in matcher.rule.items() if not k.endswith("_pattern")})
+                break
+        return WindowPolicy.from_config(config)
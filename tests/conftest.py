@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+
+def completion(content, model):
+    return {
+        "id": "test", "object": "chat.completion", "created": 0, "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+    }
+
+
+def chunk(content):
+    return {
+        "id": "test", "object": "chat.completion.chunk", "created": 0, "model": "test",
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+    }
+
+
+class MockServer:
+    """按脚本依次响应的OpenAI兼容服务
+
+    script 中每一项为一次请求的响应：
+    ("ok", 内容)、("status", 状态码, 响应头)、("sleep", 秒数, 内容)；脚本用完后返回 ("ok", "default")。
+    """
+
+    def __init__(self):
+        self.script = []
+        self.requests = []
+        self.clients = set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.requests.append(body)
+                server.clients.add(self.client_address)
+                step = server.script.pop(0) if server.script else ("ok", "default")
+                if step[0] == "status":
+                    self.send_json(step[1], {"error": {"message": "mock error"}}, step[2])
+                    return
+                if step[0] == "sleep":
+                    time.sleep(step[1])
+                    step = ("ok", step[2])
+                if body.get("stream"):
+                    self.send_stream(step[1])
+                else:
+                    self.send_json(200, completion(step[1], body.get("model")))
+
+            def send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_stream(self, content):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                events = [chunk(content[i:i + 3]) for i in range(0, len(content), 3)]
+                for event in [json.dumps(event) for event in events] + ["[DONE]"]:
+                    data = f"data: {event}\n\n".encode()
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        # 被取消的对冲请求会提前断开连接，不输出写入失败的错误
+        self.httpd.handle_error = lambda request, client_address: None
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def mock_server():
+    servers = []
+
+    def create():
+        server = MockServer()
+        servers.append(server)
+        return server
+
+    yield create
+    for server in servers:
+        server.close()
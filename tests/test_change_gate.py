@@ -0,0 +1,69 @@
+from core.change_gate import ChangeGate, screen_digest
+from core.task_guard import TaskGuard
+
+
+class FakeCollector:
+    """screens 为依次采集到的屏幕信息，signatures 为每次检查签名时签名是否变化"""
+
+    def __init__(self, screens, signatures=(), tree_cache=None, unchanged=True):
+        self.screens = list(screens)
+        self.signatures = list(signatures)
+        self.tree_cache = tree_cache
+        self.unchanged = unchanged
+        self.collections = 0
+        self.optable = None
+
+    def get_screen_info(self):
+        self.collections += 1
+        screen_info = self.screens.pop(0)
+        self.optable = f"optable:{screen_info}"
+        return screen_info
+
+    def signature_changed(self):
+        return self.signatures.pop(0) if self.signatures else False
+
+    def snapshot_unchanged(self):
+        return self.unchanged
+
+
+def confirm_twice(gate, collector):
+    first = collector.get_screen_info()
+    gate.confirm(first, collector.optable, previous_acted=False)
+    return gate.confirm(first, collector.optable, previous_acted=True)
+
+
+def test_without_cache_unchanged_signature_collects_only_once():
+    collector = FakeCollector(["A", "A"])
+    gate = ChangeGate(collector, {"recheck_waits": [0, 0, 0]})
+    confirm_twice(gate, collector)
+    # 初次采集之外只在最后一次确认时完整采集
+    assert collector.collections == 2
+    assert gate.stats["confirmed_unchanged"] == 1
+
+
+def test_without_cache_signature_change_collects_immediately():
+    collector = FakeCollector(["A", "B"], signatures=[True])
+    gate = ChangeGate(collector, {"recheck_waits": [0, 0, 0]})
+    assert confirm_twice(gate, collector) == ("B", "optable:B")
+    assert collector.collections == 2
+    assert gate.stats["saved_calls"] == 1
+
+
+def test_with_cache_unchanged_snapshot_is_recollected_on_final_recheck():
+    collector = FakeCollector(["A", "B"], tree_cache=object())
+    gate = ChangeGate(collector, {"recheck_waits": [0, 0, 0]})
+    # 没有事件的变化（例如文档文本）在最后一次确认时被发现
+    assert confirm_twice(gate, collector) == ("B", "optable:B")
+    assert collector.collections == 2
+    assert gate.stats["saved_calls"] == 1
+
+
+def test_task_guard_uses_the_gate_digest():
+    collector = FakeCollector(["A", "A", "A"])
+    gate = ChangeGate(collector, {"enabled": False})
+    guard = TaskGuard({"warn_after": 2})
+    for _ in range(3):
+        gate.confirm(collector.get_screen_info(), None, previous_acted=True)
+        warning, _ = guard.check_screen(gate.last_screen)
+    assert gate.last_screen == screen_digest("A")
+    assert guard.same_screen == 2 and warning
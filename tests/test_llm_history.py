@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+from core.llm_handler import LLMHandler, SCREEN_PLACEHOLDER
+from core.token_budget import estimate_tokens
+
+
+def make_handler(max_tokens=8000, trim_ratio=0.5, token_budget=6000, prefix_cache=True):
+    config = {
+        "OpenAI": {"api_key": "test", "model": "test-model"},
+        "History": {"max_tokens": max_tokens, "keep_recent": 2, "prefix_cache": prefix_cache, "trim_ratio": trim_ratio},
+        "ScreenInfo": {"token_budget": token_budget},
+        "Routing": {"enabled": False},
+        "OutlineCache": {"enabled": False},
+        "Prompts": {"task_prompt": {"system": "{task_str}\n{outline}", "user": "{screen_info}"}},
+    }
+    handler = LLMHandler(config)
+
+    def complete(**kwargs):
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(message=SimpleNamespace(content="click(1)\nsum(点击)"))])
+
+    handler.transport = SimpleNamespace(complete=complete, summary=dict)
+    return handler
+
+
+def test_trim_ratio_fits_one_full_screen():
+    handler = make_handler()
+    assert handler.max_history_tokens * handler.trim_ratio >= 6000
+
+
+def test_truncation_keeps_latest_full_screen_and_newest_pair():
+    handler = make_handler()
+    full_screen = "控" * 5000
+    for step in range(20):
+        full = step % 5 == 0
+        handler.process_task("任务", full_screen if full else f"屏幕变化 {step}", "大纲", full_screen=full)
+        # 最新的一轮始终保留
+        assert len(handler.history_task) >= 2
+        assert handler.history_task[-1]["role"] == "assistant"
+        # 最近一次完整屏幕信息仍在历史记录中
+        assert any(meta.get("full_screen") for meta in handler.history_meta)
+    # 之前各步的总结没有被整体清空
+    assert sum(1 for message in handler.history_task if message["role"] == "assistant") > 5
+
+
+def test_truncation_drops_oldest_pairs_first():
+    handler = make_handler(max_tokens=600, trim_ratio=0.5, token_budget=0)
+    for step in range(40):
+        handler.process_task("任务", f"{step}" + "控" * 200, "大纲", full_screen=True)
+    assert handler.history_truncations > 0
+    assert handler.history_tokens <= 600
+    assert handler.history_task[-2]["content"] == "39" + "控" * 200
+
+
+def test_compaction_replaces_old_screens_and_replies():
+    handler = make_handler(max_tokens=1000, prefix_cache=False, token_budget=0)
+    handler.process_task("任务", "第一屏" + "控" * 300, "大纲", full_screen=True)
+    handler.set_last_error("找不到控件")
+    handler.process_task("任务", "屏幕变化", "大纲", full_screen=False)
+    for step in range(3):
+        handler.process_task("任务", f"第{step}次完整屏幕" + "控" * 100, "大纲", full_screen=True)
+
+    users = [message["content"] for message in handler.history_task if message["role"] == "user"]
+    replies = [message["content"] for message in handler.history_task if message["role"] == "assistant"]
+    # 最近一次完整屏幕信息之前的屏幕信息只保留占位符，错误信息仍然保留
+    assert all(SCREEN_PLACEHOLDER in content for content in users[:-1])
+    assert "找不到控件" in users[1]
+    assert "第2次完整屏幕" in users[-1]
+    # 最近keep_recent轮之前的回复只保留总结
+    assert replies[:-2] == ["sum(点击)"] * (len(replies) - 2)
+    assert replies[-1] == "click(1)\nsum(点击)"
+    # 累计的token数与各条消息一致
+    assert handler.history_tokens == sum(estimate_tokens(message["content"]) for message in handler.history_task)
@@ -0,0 +1,180 @@
+import threading
+
+import httpx
+import openai
+import pytest
+
+from core.llm_transport import LLMTransport, RequestCancelled
+
+
+def make_transport(server, **config):
+    config = dict({"api_key": "test", "base_url": server.url, "timeout": 2, "max_retries": 3,
+                   "backoff_base": 0.01, "backoff_max": 0.05}, **config)
+    return LLMTransport(config)
+
+
+def complete(transport, **kwargs):
+    return transport.complete(model="test", messages=[{"role": "user", "content": "hi"}], **kwargs)
+
+
+def test_retries_server_errors_with_backoff(mock_server):
+    server = mock_server()
+    server.script = [("status", 503, {}), ("status", 429, {"Retry-After": "0"}), ("ok", "done")]
+    transport = make_transport(server)
+    try:
+        assert complete(transport).choices[0].message.content == "done"
+        assert len(server.requests) == 3
+        assert transport.stats["retries"] == 2
+    finally:
+        transport.close()
+
+
+def test_client_errors_are_not_retried(mock_server):
+    server = mock_server()
+    server.script = [("status", 400, {})]
+    transport = make_transport(server)
+    try:
+        with pytest.raises(openai.BadRequestError):
+            complete(transport)
+        assert len(server.requests) == 1
+    finally:
+        transport.close()
+
+
+def test_gives_up_after_max_retries(mock_server):
+    server = mock_server()
+    server.script = [("status", 500, {})] * 5
+    transport = make_transport(server, max_retries=2)
+    try:
+        with pytest.raises(openai.InternalServerError):
+            complete(transport)
+        assert len(server.requests) == 3
+    finally:
+        transport.close()
+
+
+def test_timeouts_are_retried(mock_server):
+    server = mock_server()
+    server.script = [("sleep", 1.0, "late"), ("ok", "done")]
+    transport = make_transport(server, timeout=0.3)
+    try:
+        assert complete(transport).choices[0].message.content == "done"
+        assert transport.stats["timeouts"] == 1
+    finally:
+        transport.close()
+
+
+def test_retry_after_is_honoured_and_capped():
+    transport = LLMTransport({"api_key": "test", "base_url": "http://127.0.0.1:9/v1", "backoff_max": 10})
+    try:
+        response = httpx.Response(
+            503, headers={"Retry-After": "120"}, request=httpx.Request("POST", "http://x"))
+        error = openai.InternalServerError("busy", response=response, body=None)
+        assert transport.retry_delay(error, 0) == 10
+        response = httpx.Response(400, request=response.request)
+        assert transport.retry_delay(openai.BadRequestError("bad", response=response, body=None), 0) is None
+        # 指数退避在上限的一半到全部之间
+        assert 0.5 * transport.backoff_base * 4 <= transport.retry_delay(TimeoutError(), 1) <= transport.backoff_base * 4
+    finally:
+        transport.close()
+
+
+def test_stream_yields_chunks_and_reuses_connections(mock_server):
+    server = mock_server()
+    server.script = [("ok", "click(1)\nclick(2)")]
+    transport = make_transport(server)
+    try:
+        stream = transport.stream(model="test", messages=[{"role": "user", "content": "hi"}])
+        text = "".join(chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+        assert text == "click(1)\nclick(2)"
+        for _ in range(3):
+            complete(transport)
+        assert len(server.clients) == 1
+    finally:
+        transport.close()
+
+
+def test_cancel_all_aborts_pending_requests(mock_server):
+    server = mock_server()
+    server.script = [("sleep", 1.0, "late")]
+    transport = make_transport(server)
+    try:
+        threading.Timer(0.2, transport.cancel_all).start()
+        with pytest.raises(RequestCancelled):
+            complete(transport)
+    finally:
+        transport.close()
+
+
+def make_hedged(primary, secondary, **hedge):
+    hedge = dict({"default_delay": 0.2, "min_delay": 0.05, "min_samples": 3}, **hedge)
+    return make_transport(primary, endpoints=[{"base_url": primary.url}, {"base_url": secondary.url}], hedge=hedge)
+
+
+def test_slow_primary_is_hedged_to_secondary(mock_server):
+    primary, secondary = mock_server(), mock_server()
+    primary.script = [("sleep", 1.0, "slow")]
+    secondary.script = [("ok", "fast")]
+    transport = make_hedged(primary, secondary)
+    try:
+        assert complete(transport).choices[0].message.content == "fast"
+        assert transport.stats["hedged"] == 1
+        assert transport.stats["hedge_wins"] == 1
+        assert transport.endpoints[0].stats["cancelled"] == 1
+    finally:
+        transport.close()
+
+
+def test_fast_primary_is_not_hedged(mock_server):
+    primary, secondary = mock_server(), mock_server()
+    transport = make_hedged(primary, secondary, default_delay=1.0)
+    try:
+        for _ in range(3):
+            complete(transport)
+        assert transport.stats["hedged"] == 0
+        assert not secondary.requests
+    finally:
+        transport.close()
+
+
+def test_hedge_delay_follows_latency_percentile(mock_server):
+    primary, secondary = mock_server(), mock_server()
+    transport = make_hedged(primary, secondary, default_delay=5.0, max_delay=2.0)
+    try:
+        endpoint = transport.endpoints[0]
+        # 样本不足时使用默认延迟，并受上限约束
+        assert transport.hedge_delay_for(endpoint, False) == 2.0
+        for _ in range(3):
+            complete(transport)
+        assert transport.hedge_delay_for(endpoint, False) < 1.0
+    finally:
+        transport.close()
+
+
+def test_server_error_fails_over_to_secondary(mock_server):
+    primary, secondary = mock_server(), mock_server()
+    primary.script = [("status", 503, {})]
+    secondary.script = [("ok", "fallback"), ("ok", "again")]
+    transport = make_hedged(primary, secondary, default_delay=1.0)
+    try:
+        assert complete(transport).choices[0].message.content == "fallback"
+        assert transport.stats["retries"] == 0
+        # 连续失败的地址排到后面
+        assert complete(transport).choices[0].message.content == "again"
+        assert len(primary.requests) == 1
+    finally:
+        transport.close()
+
+
+def test_stream_is_hedged_on_first_chunk(mock_server):
+    primary, secondary = mock_server(), mock_server()
+    primary.script = [("sleep", 1.0, "slow")]
+    secondary.script = [("ok", "fast stream")]
+    transport = make_hedged(primary, secondary)
+    try:
+        stream = transport.stream(model="test", messages=[{"role": "user", "content": "hi"}])
+        text = "".join(chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+        assert text == "fast stream"
+        assert transport.stats["hedge_wins"] == 1
+    finally:
+        transport.close()
@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+pytest.importorskip("uiautomation")
+
+from core.prefetch import SnapshotPrefetcher
+
+
+class SlowCollector:
+    tree_cache = None
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.collections = 0
+        self.optable = None
+
+    def get_screen_info(self):
+        time.sleep(self.seconds)
+        self.collections += 1
+        self.optable = f"T{self.collections}"
+        return f"S{self.collections}"
+
+
+def test_new_prefetch_replaces_queued_one():
+    collector = SlowCollector(0.1)
+    prefetcher = SnapshotPrefetcher(collector)
+    try:
+        # 流式模式下每执行一个操作都开始一次预取，第一次已在进行中
+        prefetcher.start()
+        time.sleep(0.03)
+        for _ in range(3):
+            prefetcher.action_executed()
+            prefetcher.start()
+        start = time.perf_counter()
+        assert prefetcher.take() == ("S2", "T2")
+        # 最多等待正在进行的一次和排队的一次
+        assert time.perf_counter() - start < 0.3
+        assert collector.collections == 2
+        assert prefetcher.stats["discarded"] == 2
+    finally:
+        prefetcher.close()
+
+
+def test_prefetch_started_before_an_action_is_discarded():
+    collector = SlowCollector(0.01)
+    prefetcher = SnapshotPrefetcher(collector)
+    try:
+        prefetcher.start()
+        prefetcher.action_executed()
+        assert prefetcher.take() is None
+        prefetcher.start()
+        assert prefetcher.take() == ("S2", "T2")
+    finally:
+        prefetcher.close()
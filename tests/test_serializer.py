@@ -0,0 +1,107 @@
+import pytest
+
+pytest.importorskip("uiautomation")
+
+from core.screen_info import ScreenInfoCollector, ElementInfo, TRUNCATION_MARK
+from core.window_policy import WindowPolicy
+
+
+def element(control_type, name="", children=()):
+    return ElementInfo(item=None, name=name, children=list(children), cached_type=control_type)
+
+
+def serialize(elements, max_text_length=500):
+    collector = ScreenInfoCollector(max_text_length=max_text_length)
+    return "".join(collector.iter_lines(elements)).splitlines(), collector
+
+
+def test_elements_are_numbered_in_preorder():
+    window = element("WindowControl", "记事本", [
+        element("ButtonControl", "文件"),
+        element("PaneControl", "编辑区", [element("EditControl", "正文")]),
+    ])
+    lines, collector = serialize([window])
+    assert lines == ["0 (Window) 记事本", "1 (Button) 文件", "2 (Pane) 编辑区", "3 (Edit) 正文"]
+    assert collector.optable.get(3).name == "正文"
+
+
+def test_empty_groups_are_dropped_and_single_child_groups_are_replaced():
+    window = element("WindowControl", "窗口", [
+        element("GroupControl", "空组"),
+        element("GroupControl", "外层", [element("ButtonControl", "确定")]),
+    ])
+    lines, _ = serialize([window])
+    assert lines == ["0 (Window) 窗口", "1 (Button) 确定"]
+
+
+def test_consecutive_text_controls_are_merged():
+    window = element("WindowControl", "窗口", [
+        element("TextControl", "第一段"),
+        element("TextControl", "第二段"),
+        element("ButtonControl", "确定"),
+        element("TextControl", "第三段"),
+    ])
+    lines, _ = serialize([window])
+    assert lines == ["0 (Window) 窗口", "1 (Text) 第一段第二段", "2 (Button) 确定", "3 (Text) 第三段"]
+
+
+def test_long_names_are_truncated():
+    window = element("WindowControl", "窗口", [element("DocumentControl", "字" * 50)])
+    lines, _ = serialize([window], max_text_length=10)
+    assert lines[1] == "1 (Document) " + "字" * 10 + TRUNCATION_MARK
+
+
+def test_unnamed_elements_are_skipped_but_their_children_are_kept():
+    window = element("WindowControl", "窗口", [element("PaneControl", "", [element("ButtonControl", "确定")])])
+    lines, _ = serialize([window])
+    assert lines == ["0 (Window) 窗口", "2 (Button) 确定"]
+
+
+def test_serializer_does_not_modify_the_tree():
+    group = element("GroupControl", "外层", [element("ButtonControl", "确定")])
+    window = element("WindowControl", "窗口", [element("TextControl", "a"), element("TextControl", "b"), group])
+    serialize([window])
+    assert [child.name for child in window.children] == ["a", "b", "外层"]
+    assert window.children[2].children[0].name == "确定"
+
+
+def test_deep_trees_do_not_recurse():
+    root = leaf = element("WindowControl", "窗口")
+    for i in range(5000):
+        child = element("PaneControl", f"层{i}")
+        leaf.children.append(child)
+        leaf = child
+    lines, _ = serialize([root])
+    assert len(lines) == 5001
+
+
+def test_compact_keeps_interactive_children_named_like_their_parent():
+    window = element("WindowControl", "窗口", [
+        element("ComboBoxControl", "地址和搜索栏", [element("EditControl", "地址和搜索栏")]),
+        element("ListItemControl", "文档", [element("ButtonControl", "文档"), element("TextControl", "文档")]),
+    ])
+    collector = ScreenInfoCollector()
+    records = list(collector.iter_records([window], compact=True))
+    assert [(record[2], record[3]) for record in records] == [
+        ("WindowControl", "窗口"),
+        ("ComboBoxControl", "地址和搜索栏"), ("EditControl", "地址和搜索栏"),
+        ("ListItemControl", "文档"), ("ButtonControl", "文档"),
+    ]
+    assert len(collector.optable) == 5
+
+
+def test_elements_hidden_by_control_types_count_towards_max_elements():
+    # 窗口下有10个面板，每个面板中有一个按钮；面板不输出，但仍需读取
+    tree = ("WindowControl", [("PaneControl", [("ButtonControl", [])]) for _ in range(10)])
+    visited = []
+
+    def make_info(raw):
+        visited.append(raw[0])
+        return ElementInfo(item=None, cached_type=raw[0])
+
+    policy = WindowPolicy(max_elements=5, control_types=frozenset({"WindowControl", "ButtonControl"}))
+    root = ScreenInfoCollector().walk_elements(tree, make_info, lambda raw: raw[1], lambda raw: len(raw[1]), 0, policy)
+    assert len(visited) == 5
+    assert root.truncated
+    assert [child.type for child in root.children] == ["ButtonControl", "ButtonControl"]
+
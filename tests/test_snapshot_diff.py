@@ -0,0 +1,97 @@
+from core.model_router import ModelRouter, FAST, STRONG
+from core.snapshot_diff import SnapshotDiffer, parse_snapshot, diff_snapshots, DIFF_HEADER
+
+SCREEN = (
+    "窗口标题: 记事本\n窗口所属进程名称: notepad.exe\n"
+    "0 (Window) 记事本\n1 (Button) 文件\n2 (Edit) 正文\n\n"
+    "窗口标题: 计算器\n窗口所属进程名称: calc.exe\n"
+    "3 (Window) 计算器\n4 (Button) 1\n"
+)
+
+
+def test_parse_snapshot_groups_lines_by_window_and_element_id():
+    windows = parse_snapshot(SCREEN)
+    assert list(windows) == ["", "窗口标题: 记事本", "窗口标题: 计算器"]
+    assert windows["窗口标题: 记事本"][2] == "2 (Edit) 正文"
+    assert windows["窗口标题: 记事本"]["窗口所属进程名称: notepad.exe"] == "窗口所属进程名称: notepad.exe"
+
+
+def test_identical_snapshots_have_no_diff():
+    assert diff_snapshots(parse_snapshot(SCREEN), parse_snapshot(SCREEN)) == ""
+
+
+def test_added_removed_and_changed_elements():
+    new = SCREEN.replace("2 (Edit) 正文", "2 (Edit) 新正文").replace("1 (Button) 文件\n", "") + "5 (Button) 2\n"
+    diff = diff_snapshots(parse_snapshot(SCREEN), parse_snapshot(new))
+    assert diff.splitlines() == [
+        "窗口标题: 记事本", "- 1 (Button) 文件", "~ 2 (Edit) 新正文",
+        "",
+        "窗口标题: 计算器", "+ 5 (Button) 2",
+    ]
+
+
+def test_opened_and_closed_windows():
+    old = SCREEN.split("\n\n")[0] + "\n"
+    new = SCREEN.split("\n\n")[1]
+    diff = diff_snapshots(parse_snapshot(old), parse_snapshot(new))
+    assert "+ 新窗口\n窗口标题: 计算器\n" in diff
+    assert "- 窗口已关闭\n窗口标题: 记事本\n" in diff
+
+
+def test_differ_sends_full_screen_without_base_and_diffs_after_commit():
+    differ = SnapshotDiffer({"full_every": 5, "max_ratio": 0.5})
+    text, full = differ.render(SCREEN)
+    assert full and text == SCREEN
+    differ.commit()
+    text, full = differ.render(SCREEN.replace("正文", "新正文"))
+    assert not full
+    assert text.startswith(DIFF_HEADER) and "~ 2 (Edit) 新正文" in text
+
+
+def test_differ_keeps_base_until_commit():
+    differ = SnapshotDiffer({})
+    differ.render(SCREEN)
+    # 模型没有收到这次的屏幕信息，下一步仍然发送完整屏幕信息
+    text, full = differ.render(SCREEN)
+    assert full
+
+
+def test_differ_sends_full_screen_every_full_every_steps_and_for_large_changes():
+    differ = SnapshotDiffer({"full_every": 2, "max_ratio": 0.5})
+    differ.render(SCREEN)
+    differ.commit()
+    for _ in range(2):
+        _, full = differ.render(SCREEN)
+        assert not full
+        differ.commit()
+    _, full = differ.render(SCREEN)
+    assert full
+    differ.commit()
+    _, full = differ.render("窗口标题: 其他\n0 (Window) 其他\n")
+    assert full
+
+
+def test_reset_forces_full_screen():
+    differ = SnapshotDiffer({})
+    differ.render(SCREEN)
+    differ.commit()
+    differ.reset()
+    _, full = differ.render(SCREEN)
+    assert full
+
+
+def test_change_ratio_escalates_only_against_a_base():
+    router = ModelRouter({"enabled": True, "fast_model": "fast", "strong_model": "strong"}, "default")
+    differ = SnapshotDiffer({})
+    # 第一步和重置后没有基准，不算作屏幕变化
+    differ.render(SCREEN)
+    assert differ.change_ratio == 0.0
+    assert router.choose(0, differ.change_ratio)[0] == FAST
+    differ.commit()
+    differ.render("窗口标题: 其他\n0 (Window) 其他\n")
+    assert router.choose(0, differ.change_ratio)[0] == STRONG
+    differ.commit()
+    differ.reset()
+    differ.render(SCREEN)
+    assert router.choose(0, differ.change_ratio)[0] == FAST
+    assert router.escalations == {"screen_change": 1}
@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import pytest
+
+from core.llm_handler import LLMHandler, ThinkFilter
+
+
+def feed_all(chunks):
+    think_filter = ThinkFilter()
+    return "".join(think_filter.feed(chunk) for chunk in chunks) + think_filter.flush()
+
+
+@pytest.mark.parametrize("chunks", [
+    ["<think>推理</think>click(1)"],
+    ["<thi", "nk>推理</th", "ink>click(1)"],
+    ["<", "t", "h", "i", "n", "k", ">", "推理", "<", "/think", ">", "click(1)"],
+])
+def test_think_filter_removes_tags_split_across_chunks(chunks):
+    assert feed_all(chunks) == "click(1)"
+
+
+def test_think_filter_keeps_text_that_only_looks_like_a_tag():
+    assert feed_all(["a <thin", "g> b"]) == "a <thing> b"
+    assert feed_all(["a <thi"]) == "a <thi"
+
+
+def test_think_filter_drops_unclosed_think():
+    assert feed_all(["click(1)\n<think>未结束"]) == "click(1)\n"
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+        self.consumed = 0
+
+    def __iter__(self):
+        for text in self.chunks:
+            self.consumed += 1
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+    def close(self):
+        self.closed = True
+
+
+def make_handler(chunks):
+    config = {
+        "OpenAI": {"api_key": "test", "model": "test-model", "stream": True},
+        "Routing": {"enabled": False},
+        "OutlineCache": {"enabled": False},
+        "Prompts": {"task_prompt": {"system": "{task_str}\n{outline}", "user": "{screen_info}"}},
+    }
+    handler = LLMHandler(config)
+    stream = FakeStream(chunks)
+    handler.transport = SimpleNamespace(stream=lambda **kwargs: stream, summary=dict)
+    return handler, stream
+
+
+def test_lines_are_executed_as_they_arrive():
+    handler, stream = make_handler(["<think>先点击</think>cli", "ck(1)\nclick", "(2)\nsum(完成)"])
+    executed = []
+
+    def on_line(line):
+        # 执行第一行时，后面的分块还没有被读取
+        executed.append((line, stream.consumed))
+        return True
+
+    response = handler.process_task("任务", "屏幕", "大纲", on_line=on_line)
+    assert executed == [("click(1)", 2), ("click(2)", 3), ("sum(完成)", 3)]
+    assert response == "click(1)\nclick(2)\nsum(完成)"
+    assert stream.closed
+
+
+def test_on_line_returning_false_stops_receiving():
+    handler, stream = make_handler(["click(1)\n", "click(2)\n", "click(3)\n"])
+    executed = []
+
+    def on_line(line):
+        executed.append(line)
+        return False
+
+    handler.process_task("任务", "屏幕", "大纲", on_line=on_line)
+    assert executed == ["click(1)"]
+    assert stream.consumed == 1
+    assert stream.closed
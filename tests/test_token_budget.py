@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+from core.token_budget import TokenBudget, HIDDEN, estimate_tokens
+
+
+def element(control_type, name="", children=(), runtime_id=()):
+    return SimpleNamespace(type=control_type, name=name, children=list(children),
+                           runtime_id=runtime_id, collapsed_children=0)
+
+
+def explorer_window(file_count=3000):
+    toolbar = element("ToolBarControl", "工具栏", [element("ButtonControl", f"按钮{i}") for i in range(20)])
+    nav = element("TreeControl", "导航窗格", [element("TreeItemControl", f"文件夹{i}") for i in range(30)])
+    files = element("ListControl", "项目视图",
+                    [element("ListItemControl", f"file_{i:04d}.txt") for i in range(file_count)])
+    root = element("WindowControl", "Explorer", [toolbar, nav, files])
+    return root, toolbar, nav, files
+
+
+def test_within_budget_collapses_nothing():
+    root, *_ = explorer_window(10)
+    collapsed, tokens = TokenBudget(6000).plan([([root], "窗口标题: Explorer\n", True)])
+    assert collapsed == {}
+    assert tokens < 6000
+
+
+def test_large_list_is_partially_collapsed_close_to_budget():
+    root, toolbar, nav, files = explorer_window()
+    target = files.children[1234]
+    budget = TokenBudget(6000)
+    budget.set_context("打开文件 file_1234.txt")
+    collapsed, tokens = budget.plan([([root], "窗口标题: Explorer\n", True)])
+
+    # 窗口本身和目标文件仍然可见，只隐藏列表中的一部分项目
+    assert id(root) not in collapsed
+    assert id(target) not in collapsed
+    hidden = collapsed[id(files)]
+    assert 0 < hidden < len(files.children)
+    assert sum(1 for item in files.children if collapsed.get(id(item)) == HIDDEN) == hidden
+    # 结果接近预算而不是远低于预算
+    assert 0.9 * 6000 <= tokens <= 6000
+
+
+def test_background_window_folds_before_foreground():
+    foreground, *_ = explorer_window(500)
+    background = element("WindowControl", "Background",
+                         [element("ListItemControl", f"item_{i:04d}") for i in range(1000)])
+    collapsed, tokens = TokenBudget(4000).plan([([background], "窗口标题: Background\n", False),
+                                               ([foreground], "窗口标题: Explorer\n", True)])
+    assert collapsed.get(id(background), 0) > 0
+    # 折叠后台窗口已满足预算，前台窗口中的元素都不折叠
+    stack = [foreground]
+    while stack:
+        node = stack.pop()
+        assert id(node) not in collapsed
+        stack.extend(node.children)
+    assert tokens <= 4000
+
+
+def test_expanded_element_is_kept():
+    root, toolbar, nav, files = explorer_window(2000)
+    nav.runtime_id = (42, 1)
+    collapsed, _ = TokenBudget(3000).plan([([root], "窗口标题: Explorer\n", True)], expanded={(42, 1)})
+    assert id(nav) not in collapsed
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("中文") == 2
@@ -0,0 +1,143 @@
+import time
+from types import SimpleNamespace
+
+from core.tree_cache import UITreeCache, FakeEventProvider
+
+
+def node(runtime_id, children=(), name="", depth=0):
+    return SimpleNamespace(runtime_id=runtime_id, children=list(children), name=name, item=runtime_id,
+                           depth=depth, spliced_ids=())
+
+
+class FakeWindow:
+    """按RuntimeId描述窗口内容，collect每次都返回新的节点，并记录被重新获取的控件"""
+
+    def __init__(self):
+        self.control = SimpleNamespace(NativeWindowHandle=100, runtime_id=(1,))
+        self.names = {}
+        self.collected = []
+        self.refreshed = []
+
+    def build(self, runtime_id, depth):
+        # 窗口(1,)下有两个面板，每个面板下有三个控件
+        if runtime_id == (1,):
+            children = [(1, 1), (1, 2)]
+        elif len(runtime_id) == 2:
+            children = [runtime_id + (i,) for i in range(3)]
+        else:
+            children = []
+        return node(runtime_id, [self.build(child, depth + 1) for child in children],
+                    self.names.get(runtime_id, ""), depth)
+
+    def collect(self, control, depth):
+        runtime_id = getattr(control, "runtime_id", control)
+        self.collected.append(runtime_id)
+        return self.build(runtime_id, depth)
+
+    def refresh(self, element_info):
+        self.refreshed.append(element_info.runtime_id)
+        element_info.name = self.names.get(element_info.runtime_id, "")
+
+    def get(self, cache, tag=None):
+        cache.begin_snapshot([(1,)])
+        return cache.get((1,), self.control, self.collect, self.refresh, tag)
+
+
+def make_cache(**kwargs):
+    provider = FakeEventProvider()
+    return provider, UITreeCache(provider, **kwargs), FakeWindow()
+
+
+def test_window_is_fetched_once_without_events():
+    provider, cache, window = make_cache()
+    first = window.get(cache)
+    second = window.get(cache)
+    assert second is first
+    assert window.collected == [(1,)]
+    assert not cache.has_changes()
+
+
+def test_structure_event_refetches_only_that_subtree():
+    provider, cache, window = make_cache()
+    root = window.get(cache)
+    untouched = root.children[1]
+    provider.emit((1, 1), structural=True)
+    assert cache.has_changes()
+    root = window.get(cache)
+    assert window.collected == [(1,), (1, 1)]
+    assert root.children[1] is untouched
+    assert cache.stats["subtree_fetches"] == 1
+
+
+def test_property_event_refreshes_only_that_element():
+    provider, cache, window = make_cache()
+    window.get(cache)
+    window.names[(1, 2, 0)] = "新名称"
+    provider.emit((1, 2, 0), structural=False)
+    root = window.get(cache)
+    assert window.refreshed == [(1, 2, 0)]
+    assert window.collected == [(1,)]
+    assert root.children[1].children[0].name == "新名称"
+
+
+def test_events_outside_cached_windows_are_ignored():
+    provider, cache, window = make_cache()
+    window.get(cache)
+    provider.emit((9, 9), structural=True)
+    assert not cache.has_changes()
+    window.get(cache)
+    assert window.collected == [(1,)]
+
+
+def test_speculative_refresh_applies_events_without_snapshot():
+    provider, cache, window = make_cache()
+    window.get(cache, tag="foreground")
+    assert cache.begin_refresh() == []
+    provider.emit((1, 2), structural=True)
+    provider.emit((9, 9), structural=True)
+    targets = cache.begin_refresh()
+    assert targets == [(100, (1,), "foreground")]
+    cache.get((1,), window.control, window.collect, window.refresh, "foreground")
+    assert window.collected == [(1,), (1, 2)]
+    # 缓存已更新，但屏幕仍与上一次快照不同
+    assert cache.has_changes()
+    window.get(cache, tag="foreground")
+    assert window.collected == [(1,), (1, 2)]
+    assert not cache.has_changes()
+
+
+def test_invalidate_refetches_whole_window():
+    provider, cache, window = make_cache()
+    window.get(cache)
+    cache.invalidate()
+    assert cache.has_changes()
+    window.get(cache)
+    assert window.collected == [(1,), (1,)]
+
+
+def test_policy_change_and_max_age_refetch_window():
+    provider, cache, window = make_cache(max_age=0.05)
+    window.get(cache, tag="background")
+    window.get(cache, tag="foreground")
+    assert window.collected == [(1,), (1,)]
+    time.sleep(0.06)
+    window.get(cache, tag="foreground")
+    assert window.collected == [(1,), (1,), (1,)]
+
+
+def test_expired_window_counts_as_changed():
+    provider, cache, window = make_cache(max_age=0.05)
+    window.get(cache)
+    assert not cache.has_changes()
+    time.sleep(0.06)
+    assert cache.has_changes()
+    window.get(cache)
+    assert not cache.has_changes()
+
+
+def test_closed_windows_are_dropped():
+    provider, cache, window = make_cache()
+    window.get(cache)
+    cache.begin_snapshot([])
+    provider.emit((1, 1), structural=True)
+    assert not cache.has_changes()